@@ -0,0 +1,626 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark of the frePPLe exporter on synthetic data.
+
+A catalog of the requested number of products is generated in an in-memory
+stand-in of Odoo, together with a weekly and a two-week calendar, warehouses
+and locations, customers and suppliers, bills of material with variants, open purchase and manufacturing
+orders and stock quants. The complete export of mode 1 is then generated
+and the statistics of every section are reported.
+
+Usage:
+  python3 benchmark/bench_exporter.py [--scales 10000,100000] [--no-memory]
+                                      [--calendar-horizon DAYS]
+                                      [--json results.json]
+
+With --calendar-horizon the two-week calendar is only expanded over the
+given number of days, rather than from 2020 till 2030.
+
+The memory is measured with tracemalloc, which slows down the export.
+A scale of 1000000 products needs several GB of memory for the fake data.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import fake_odoo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Warehouses with open orders are limited to these names in the exporter
+WAREHOUSES = [
+    "Rolleston 32",
+    "Spex R24 (Transfer Only)",
+    "R24 Spex Limited Sales",
+    "R24 Medifab Limited Sales",
+]
+COMPANY = "Medifab"
+
+
+def query_onhand(db, params):
+    # Query of exporter.export_onhand
+    views = {}
+    for wh in db.table("stock.warehouse").records.values():
+        if wh["view_location_id"][0] in params[0]:
+            views[wh["view_location_id"][0]] = wh["name"]
+    warehouse = {}
+    for loc_id, loc in db.table("stock.location").records.items():
+        for i in reversed(loc["parent_path"].split("/")):
+            if i and int(i) in views:
+                warehouse[loc_id] = views[int(i)]
+                break
+    inventory = {}
+    for product_id, location_id, quantity in db.raw["stock_quant"]:
+        if quantity > 0 and location_id in warehouse:
+            key = (warehouse[location_id], product_id)
+            inventory[key] = inventory.get(key, 0) + quantity
+    return (
+        ["name", "product_id", "sum"],
+        sorted((k[0], k[1], v) for k, v in inventory.items()),
+    )
+
+
+def build_database(products, seed=0):
+    """
+    Generates a database with the given number of product variants.
+    Every product template has two variants.
+    """
+    rnd = random.Random(seed)
+    db = fake_odoo.FakeDatabase("bench_%s" % products)
+    db.register_query(r"FROM stock_quant", query_onhand)
+    now = datetime(2024, 1, 1)
+
+    for model in (
+        "ir.model",
+        "ir.logging",
+        "res.users",
+        "uom.uom",
+        "resource.calendar",
+        "resource.calendar.attendance",
+        "resource.calendar.leaves",
+        "stock.location",
+        "mrp.workcenter",
+        "product.category",
+        "stock.location.route",
+        "product.template",
+        "product.product",
+        "product.supplierinfo",
+        "mrp.routing",
+        "mrp.routing.workcenter",
+        "mrp.bom",
+        "mrp.bom.line",
+        "mrp.production",
+    ):
+        db.add_model(model)
+    db.add_model("res.company", {"manufacturing_warehouse": "stock.warehouse"})
+    db.add_model("res.partner")
+    db.add_model("stock.warehouse")
+    db.add_model("frepple.export.watermark", {"company_id": "res.company"})
+    db.add_model("purchase.order", {"partner_id": "res.partner"})
+    db.add_model("purchase.order.line", {"order_id": "purchase.order"})
+    db.raw["stock_quant"] = []
+
+    db.table("res.users").insert({"name": "admin", "tz": "Pacific/Auckland"})
+    uom = db.table("uom.uom")
+    uom.insert(
+        {
+            "name": "Units",
+            "factor": 1.0,
+            "uom_type": "reference",
+            "category_id": [1, "Unit"],
+            "active": True,
+        }
+    )
+    uom.insert(
+        {
+            "name": "Dozens",
+            "factor": 1 / 12.0,
+            "uom_type": "bigger",
+            "category_id": [1, "Unit"],
+            "active": True,
+        }
+    )
+    uom.insert(
+        {
+            "name": "kg",
+            "factor": 1.0,
+            "uom_type": "reference",
+            "category_id": [2, "Weight"],
+            "active": True,
+        }
+    )
+
+    # Calendar
+    cal = db.table("resource.calendar").insert(
+        {"name": "Working hours", "tz": "Pacific/Auckland"}
+    )
+    for day in range(5):
+        for hour_from, hour_to in ((8, 12), (13, 17)):
+            db.table("resource.calendar.attendance").insert(
+                {
+                    "dayofweek": str(day),
+                    "date_from": False,
+                    "date_to": False,
+                    "hour_from": hour_from,
+                    "hour_to": hour_to,
+                    "calendar_id": [cal, "Working hours"],
+                }
+            )
+    for day in range(10):
+        db.table("resource.calendar.leaves").insert(
+            {
+                "time_type": "leave",
+                "date_from": now + timedelta(days=30 * day),
+                "date_to": now + timedelta(days=30 * day + 1),
+                "calendar_id": [cal, "Working hours"],
+            }
+        )
+
+    # Two-week calendar, alternating early and late shifts
+    shifts = db.table("resource.calendar").insert(
+        {"name": "Two-week shifts", "tz": "Pacific/Auckland"}
+    )
+    for week_type, hour_from, hour_to in (("0", 6, 14), ("1", 14, 22)):
+        for day in range(5):
+            db.table("resource.calendar.attendance").insert(
+                {
+                    "dayofweek": str(day),
+                    "date_from": False,
+                    "date_to": False,
+                    "hour_from": hour_from,
+                    "hour_to": hour_to,
+                    "week_type": week_type,
+                    "display_type": False,
+                    "calendar_id": [shifts, "Two-week shifts"],
+                }
+            )
+
+    # Warehouses, with a tree of bins below their stock location
+    locations = db.table("stock.location")
+    bins = []
+    stock_locations = {}
+
+    def location(name, parent=None):
+        loc_id = locations.next_id
+        locations.insert(
+            {
+                "name": name,
+                "location_id": [parent, ""] if parent else False,
+                "parent_path": "%s%s/"
+                % (locations.records[parent]["parent_path"] if parent else "", loc_id),
+            }
+        )
+        return loc_id
+
+    for wh_id, name in enumerate(WAREHOUSES, start=1):
+        view = location(name)
+        stock = location("Stock", view)
+        vals = {
+            "id": wh_id,
+            "name": name,
+            "view_location_id": [view, name],
+            "lot_stock_id": [stock, "Stock"],
+        }
+        for field in (
+            "wh_input_stock_loc_id",
+            "wh_output_stock_loc_id",
+            "wh_pack_stock_loc_id",
+            "wh_qc_stock_loc_id",
+        ):
+            vals[field] = [location(field, view), field]
+        db.table("stock.warehouse").insert(vals)
+        stock_locations[name] = stock
+        for aisle in range(max(1, products // 2000)):
+            parent = location("Aisle %s" % aisle, stock)
+            for shelf in range(5):
+                bins.append(location("Shelf %s" % shelf, location("Rack", parent)))
+    # Locations outside the warehouses
+    for i in range(10):
+        location("Partner location %s" % i)
+
+    db.table("res.company").insert(
+        {
+            "name": COMPANY,
+            "security_lead": 0,
+            "po_lead": 1,
+            "manufacturing_lead": 1,
+            "calendar": [cal, "Working hours"],
+            "manufacturing_warehouse": [1, WAREHOUSES[0]],
+        }
+    )
+
+    # Partners
+    partners = db.table("res.partner")
+    customers = []
+    suppliers = []
+    for i in range(max(10, products // 10)):
+        customers.append(
+            partners.insert(
+                {
+                    "name": "Customer %s" % i,
+                    "customer": True,
+                    "supplier": False,
+                    "write_date": now,
+                }
+            )
+        )
+    for i in range(max(5, products // 100)):
+        suppliers.append(
+            partners.insert(
+                {
+                    "name": "Supplier %s" % i,
+                    "customer": False,
+                    "supplier": True,
+                    "write_date": now,
+                }
+            )
+        )
+
+    # Workcenters and routings
+    workcenters = []
+    for i in range(20):
+        workcenters.append(
+            db.table("mrp.workcenter").insert(
+                {
+                    "name": "Workcenter %s" % i,
+                    "capacity": 1,
+                    "resource_calendar_id": [cal, "Working hours"],
+                    "write_date": now,
+                }
+            )
+        )
+    routings = []
+    for i in range(10):
+        routing = db.table("mrp.routing").insert(
+            {"location_id": [stock_locations[WAREHOUSES[0]], ""], "write_date": now}
+        )
+        routings.append(routing)
+        for seq in range(3):
+            wc = rnd.choice(workcenters)
+            db.table("mrp.routing.workcenter").insert(
+                {
+                    "name": "Step %s" % seq,
+                    "routing_id": [routing, "Routing %s" % i],
+                    "workcenter_id": [wc, "Workcenter %s" % (wc - 1)],
+                    "sequence": seq * 10,
+                    "time_cycle": 30.0,
+                    "write_date": now,
+                }
+            )
+
+    # Catalog
+    categories = []
+    for i in range(50):
+        categories.append(
+            db.table("product.category").insert(
+                {
+                    "name": "Category %s" % i,
+                    "parent_id": (
+                        [categories[i // 5], "Category %s" % (i // 5)]
+                        if i >= 5
+                        else False
+                    ),
+                }
+            )
+        )
+    for name in ("Buy", "Manufacture", "Make To Order"):
+        db.table("stock.location.route").insert({"name": name})
+
+    templates = db.table("product.template")
+    variants = db.table("product.product")
+    purchased = []
+    manufactured = []
+    for i in range(max(1, products // 2)):
+        tmpl_id = templates.next_id
+        kind = i % 4
+        categ = rnd.choice(categories)
+        product_ids = [variants.next_id, variants.next_id + 1]
+        for v in range(2):
+            variants.insert(
+                {
+                    "name": "Product %s" % i,
+                    "code": "P%s-%s" % (i, v),
+                    "product_tmpl_id": [tmpl_id, "Product %s" % i],
+                    "seller_ids": [],
+                    "attribute_value_ids": [v + 1],
+                    "lst_price": 10.0,
+                    "write_date": now,
+                }
+            )
+        templates.insert(
+            {
+                "type": "product",
+                "purchase_ok": kind != 0,
+                "route_ids": [],
+                "bom_ids": [],
+                "produce_delay": 1.0,
+                "list_price": 10.0 + i % 100,
+                "uom_id": [1 if kind else 2, "Units" if kind else "Dozens"],
+                "seller_ids": [],
+                "standard_price": 5.0,
+                "categ_id": [categ, "Category %s" % (categ - 1)],
+                "product_variant_ids": product_ids,
+                "write_date": now,
+            }
+        )
+        if kind == 0:
+            manufactured.append((tmpl_id, product_ids))
+        else:
+            purchased.append((tmpl_id, product_ids))
+            db.table("product.supplierinfo").insert(
+                {
+                    "product_tmpl_id": [tmpl_id, "Product %s" % i],
+                    "name": [rnd.choice(suppliers), "Supplier"],
+                    "delay": 7,
+                    "min_qty": 1.0,
+                    "date_end": False,
+                    "date_start": now,
+                    "price": 5.0,
+                    "sequence": 1,
+                    "write_date": now,
+                }
+            )
+
+    # Bills of material, with one line specific to each variant
+    boms = []
+    for tmpl_id, product_ids in manufactured:
+        routing = rnd.choice(routings) if rnd.random() < 0.3 else None
+        bom = db.table("mrp.bom").insert(
+            {
+                "product_qty": 1.0,
+                "product_uom_id": [1, "Units"],
+                "product_tmpl_id": [tmpl_id, ""],
+                "routing_id": [routing, ""] if routing else False,
+                "type": "normal",
+                "sequence": 1,
+                "write_date": now,
+            }
+        )
+        boms.append((bom, product_ids))
+        for line in range(4):
+            component = rnd.choice(purchased)[1][0] if purchased else product_ids[0]
+            db.table("mrp.bom.line").insert(
+                {
+                    "bom_id": [bom, ""],
+                    "product_qty": 2.0,
+                    "product_uom_id": [1, "Units"],
+                    "product_id": [component, ""],
+                    "routing_id": False,
+                    "attribute_value_ids": [line % 2 + 1] if line >= 2 else [],
+                }
+            )
+
+    # Open purchase orders
+    for i in range(max(1, products // 50)):
+        warehouse = rnd.randrange(len(WAREHOUSES)) + 1
+        supplier = rnd.choice(suppliers)
+        order = db.table("purchase.order").insert(
+            {
+                "name": "PO%05d" % i,
+                "company_id": [1, COMPANY],
+                "partner_id": [supplier, "Supplier"],
+                "state": "purchase",
+                "date_order": now,
+                "warehouse_id": [warehouse, WAREHOUSES[warehouse - 1]],
+                "write_date": now,
+            }
+        )
+        for line in range(5):
+            product = rnd.choice(purchased)[1][line % 2] if purchased else 1
+            db.table("purchase.order.line").insert(
+                {
+                    "name": "Line %s" % line,
+                    "date_planned": now + timedelta(days=line),
+                    "product_id": [product, ""],
+                    "product_qty": 10.0,
+                    "qty_received": 2.0,
+                    "product_uom": [1, "Units"],
+                    "order_id": [order, "PO%05d" % i],
+                    "state": "purchase",
+                    "write_date": now,
+                }
+            )
+
+    # Open manufacturing orders
+    for i in range(max(1, products // 20)) if boms else ():
+        bom, product_ids = rnd.choice(boms)
+        db.table("mrp.production").insert(
+            {
+                "bom_id": [bom, ""],
+                "date_start": False,
+                "date_planned_start": now + timedelta(days=i % 30),
+                "name": "MO%05d" % i,
+                "state": rnd.choice(["confirmed", "planned", "progress"]),
+                "product_qty": 5.0,
+                "product_uom_id": [1, "Units"],
+                "location_dest_id": [stock_locations[WAREHOUSES[0]], ""],
+                "product_id": [product_ids[i % 2], ""],
+                "origin": "SO%05d, WH/MO" % i,
+                "priority": "1",
+                "write_date": now,
+            }
+        )
+
+    # Stock quants
+    quants = db.raw["stock_quant"]
+    for i in range(products * 2):
+        quants.append((rnd.randrange(products) + 1, rnd.choice(bins), 5.0))
+    return db
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts the records the exporter skipped because of an error. The
+    exporter also logs the start of every section at the error level.
+    """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+        self.first = None
+
+    def emit(self, record):
+        message = record.getMessage()
+        if not message.startswith("===="):
+            self.count += 1
+            if self.first is None:
+                self.first = message
+
+
+def run(products, memory=True, calendar_horizon=None, out=sys.stdout):
+    """
+    Runs a full export on a database of the given number of products and
+    returns the statistics of every section.
+    """
+    start = time.perf_counter()
+    db = build_database(products)
+    generation = time.perf_counter() - start
+    fake_odoo.install(db)
+    outbound = fake_odoo.load_module(
+        "frepple_outbound",
+        os.path.join(ROOT, "frepple", "controllers", "outbound.py"),
+    )
+    errors = ErrorCounter()
+    outbound.logger.addHandler(errors)
+    outbound.logger.setLevel(logging.ERROR)
+    outbound.logger.propagate = False
+    env = fake_odoo.FakeEnv(db)
+    xp = outbound.exporter(
+        fake_odoo.FakeRequest(env),
+        uid=1,
+        database=db.name,
+        company=COMPANY,
+        mode=1,
+        use_cache=False,
+        profile_memory=memory,
+        calendar_horizon=calendar_horizon,
+    )
+    start = time.perf_counter()
+    size = 0
+    for chunk in xp.run_chunked():
+        size += len(chunk.encode("utf-8"))
+    elapsed = time.perf_counter() - start
+    # Highest of the peaks measured by the exporter for each section
+    peak = max((i["memory_peak"] or 0 for i in xp.section_stats), default=0)
+
+    print(
+        "\n%s products: data generated in %.1fs, exported %s bytes in %.2fs%s"
+        % (
+            products,
+            generation,
+            size,
+            elapsed,
+            ", peak memory %.1f MB" % (peak / 1048576.0) if peak else "",
+        ),
+        file=out,
+    )
+    print(
+        "%-28s %9s %12s %12s %12s %8s %12s"
+        % (
+            "section",
+            "seconds",
+            "rows read/s",
+            "rows out/s",
+            "bytes/s",
+            "queries",
+            "peak MB",
+        ),
+        file=out,
+    )
+    for i in xp.section_stats:
+        wall = i["wall"] or 1e-9
+        print(
+            "%-28s %9.3f %12.0f %12.0f %12.0f %8d %12s"
+            % (
+                i["section"],
+                i["wall"],
+                i["rows_read"] / wall,
+                i["rows_emitted"] / wall,
+                i["bytes"] / wall,
+                i["queries"],
+                (
+                    "%.1f" % (i["memory_peak"] / 1048576.0)
+                    if i["memory_peak"] is not None
+                    else ""
+                ),
+            ),
+            file=out,
+        )
+    if errors.count:
+        # The timings then partly measure the error handling
+        print(
+            "%s records skipped because of errors, eg: %s"
+            % (errors.count, errors.first),
+            file=out,
+        )
+    return {
+        "products": products,
+        "seconds": elapsed,
+        "bytes": size,
+        "memory_peak": peak,
+        "errors": errors.count,
+        "sections": xp.section_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scales",
+        default="10000,100000",
+        help="comma separated numbers of products (default 10000,100000)",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="don't measure the memory, which is much faster",
+    )
+    parser.add_argument(
+        "--calendar-horizon",
+        type=int,
+        help="number of days over which two-week calendars are expanded",
+    )
+    parser.add_argument("--json", help="file to store the results in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = [
+        run(
+            int(i),
+            memory=not args.no_memory,
+            calendar_horizon=args.calendar_horizon,
+        )
+        for i in args.scales.split(",")
+    ]
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(i["errors"] for i in results):
+        sys.exit("The export skipped records because of errors")
+
+
+if __name__ == "__main__":
+    main()
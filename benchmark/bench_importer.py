@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark of the frePPLe importer on synthetic plan uploads.
+
+For every order type (purchase orders, distribution orders, manufacturing
+orders and work orders) and every scale, a frePPLe plan with that number
+of operationplans is generated and uploaded to the importer, running on
+an in-memory stand-in of Odoo that records the ORM calls.
+The number of elements processed per second, the ORM calls and queries per
+element and the peak memory are reported.
+
+Usage:
+  python3 benchmark/bench_importer.py [--scales 1000,10000,100000]
+                                      [--types PO,DO,MO,WO] [--calls]
+                                      [--no-memory] [--json results.json]
+
+With --calls the ORM calls per model and method are listed as well.
+The memory is measured with tracemalloc, which slows down the import.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr
+
+import fake_odoo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WAREHOUSES = ["WH1", "WH2", "WH3", "WH4"]
+DATEFORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def build_database(elements, seed=0):
+    """
+    Generates the Odoo data referenced by an upload of the given size:
+    products with their suppliers, warehouses with their stock locations and
+    internal transfer picking types, and the manufacturing orders and work
+    orders that the upload reschedules.
+    """
+    rnd = random.Random(seed)
+    db = fake_odoo.FakeDatabase("bench_import_%s" % elements)
+    for model in (
+        "res.users",
+        "product.template",
+        "stock.warehouse",
+        "stock.location",
+        "stock.picking.type",
+        "purchase.order",
+        "mrp.workcenter",
+    ):
+        db.add_model(model)
+    db.add_model("res.company")
+    db.add_model("product.product", {"product_tmpl_id": "product.template"})
+    db.add_model("product.supplierinfo", {"product_tmpl_id": "product.template"})
+    db.add_model(
+        "purchase.order.line",
+        {"order_id": "purchase.order"},
+        converters={"product_qty": float},
+    )
+    db.add_model(
+        "stock.picking",
+        {"location_id": "stock.location", "location_dest_id": "stock.location"},
+        defaults={"name": lambda i: "WH/INT/%05d" % i},
+    )
+    db.add_model("stock.move", converters={"product_uom_qty": float})
+    db.add_model("mrp.production")
+    db.add_model("mrp.workorder", {"production_id": "mrp.production"})
+
+    db.table("res.users").insert({"name": "admin", "login": "admin", "tz": "UTC"})
+    db.table("res.company").insert({"name": "Company"})
+
+    products = max(100, elements // 10)
+    suppliers = max(10, elements // 100)
+    for i in range(products):
+        tmpl = db.table("product.template").insert({"name": "Product %s" % i})
+        db.table("product.product").insert(
+            {"name": "Product %s" % i, "product_tmpl_id": [tmpl, "Product %s" % i]}
+        )
+        for qty in (1.0, 100.0):
+            db.table("product.supplierinfo").insert(
+                {
+                    "name": [rnd.randrange(suppliers) + 1, "Supplier"],
+                    "product_tmpl_id": [tmpl, "Product %s" % i],
+                    "min_qty": qty,
+                    "price": 10.0 if qty < 100 else 8.0,
+                }
+            )
+
+    for name in WAREHOUSES:
+        wh = db.table("stock.warehouse").insert({"name": name})
+        for loc in ("Stock", "Input", "Output"):
+            loc_id = db.table("stock.location").insert(
+                {
+                    "name": "%s/%s" % (name, loc),
+                    "usage": "internal",
+                    "warehouse_id": [wh, name],
+                }
+            )
+            if loc == "Stock":
+                db.table("stock.picking.type").insert(
+                    {
+                        "name": "Internal Transfers",
+                        "default_location_src_id": [loc_id, ""],
+                    }
+                )
+
+    now = datetime(2024, 1, 1)
+    for i in range(max(1, elements // 2)):
+        mo = db.table("mrp.production").insert(
+            {"name": "MO%06d" % i, "date_planned_start": now, "state": "confirmed"}
+        )
+        for step in range(2):
+            db.table("mrp.workorder").insert(
+                {
+                    "production_id": [mo, "MO%06d" % i],
+                    "state": "ready",
+                    "display_name": "MO%06d - Step %s" % (i, step),
+                }
+            )
+    return db, products, suppliers
+
+
+def generate_plan(ordertype, elements, products, suppliers, seed=0):
+    """
+    Returns the XML of a frePPLe plan with operationplans of a single type.
+    """
+    rnd = random.Random(seed)
+    start = datetime(2024, 2, 1)
+    out = ["<?xml version='1.0' encoding='UTF-8'?>\n<plan>\n<operationplans>\n"]
+    for i in range(elements):
+        product = rnd.randrange(products) + 1
+        begin = start + timedelta(hours=rnd.randrange(2000))
+        end = begin + timedelta(days=rnd.randrange(1, 10))
+        attrs = {
+            "ordertype": ordertype,
+            "item": "Product %s" % (product - 1),
+            "item_id": "1,%s" % product,
+            "quantity": "%s" % float(rnd.randrange(1, 200)),
+            "start": begin.strftime(DATEFORMAT),
+            "end": end.strftime(DATEFORMAT),
+        }
+        if ordertype == "PO":
+            supplier = rnd.randrange(suppliers) + 1
+            attrs["supplier"] = "%s Supplier %s" % (supplier, supplier)
+        elif ordertype == "DO":
+            origin, destination = rnd.sample(WAREHOUSES, 2)
+            attrs["origin"] = origin
+            attrs["destination"] = destination
+        elif ordertype == "MO":
+            attrs["reference"] = "MO%06d" % rnd.randrange(max(1, elements // 2))
+        elif ordertype == "WO":
+            mo = rnd.randrange(max(1, elements // 2))
+            attrs["owner"] = "MO%06d" % mo
+            attrs["operation"] = "MO%06d - Step %s" % (mo, rnd.randrange(2))
+        out.append(
+            "<operationplan %s/>\n"
+            % " ".join("%s=%s" % (k, quoteattr(v)) for k, v in attrs.items())
+        )
+    out.append("</operationplans>\n</plan>\n")
+    return "".join(out).encode("utf-8")
+
+
+def run(ordertype, elements, calls=False, memory=True):
+    """
+    Uploads a plan of the given type and size, and returns the statistics.
+    """
+    db, products, suppliers = build_database(elements)
+    plan = generate_plan(ordertype, elements, products, suppliers)
+    fake_odoo.install(db)
+    inbound = fake_odoo.load_module(
+        "frepple_inbound",
+        os.path.join(ROOT, "frepple", "controllers", "inbound.py"),
+    )
+    env = fake_odoo.FakeEnv(db)
+    ip = inbound.importer(
+        fake_odoo.FakeRequest(env, files={"frePPLe plan": io.BytesIO(plan)}),
+        database=db.name,
+        company=env["res.company"].browse(1),
+        mode=1,
+    )
+    db.calls.clear()
+    queries = env.cr.sql_log_count
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    # The reply holds a line per failed element, followed by two summary lines
+    errors = len(ip.run().split("\n")) - 2
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    orm_calls = sum(db.calls.values())
+    result = {
+        "ordertype": ordertype,
+        "elements": elements,
+        "seconds": elapsed,
+        "elements_per_second": elements / (elapsed or 1e-9),
+        "orm_calls_per_element": orm_calls / float(elements),
+        "queries_per_element": (env.cr.sql_log_count - queries) / float(elements),
+        "memory_peak": peak,
+        "errors": errors,
+    }
+    print(
+        "%-4s %9d %9.2f %12.0f %12.2f %12.2f %10.1f %7d"
+        % (
+            ordertype,
+            elements,
+            elapsed,
+            result["elements_per_second"],
+            result["orm_calls_per_element"],
+            result["queries_per_element"],
+            peak / 1048576.0,
+            errors,
+        )
+    )
+    if calls:
+        result["calls"] = {
+            "%s.%s" % k: v / float(elements) for k, v in db.calls.most_common()
+        }
+        for k, v in result["calls"].items():
+            print("        %-40s %8.2f per element" % (k, v))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scales",
+        default="1000,10000,100000",
+        help="comma separated numbers of operationplans (default 1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--types",
+        default="PO,DO,MO,WO",
+        help="comma separated order types (default PO,DO,MO,WO)",
+    )
+    parser.add_argument(
+        "--calls",
+        action="store_true",
+        help="list the ORM calls per model and method",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="don't measure the memory, which is much faster",
+    )
+    parser.add_argument("--json", help="file to store the results in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    print(
+        "%-4s %9s %9s %12s %12s %12s %10s %7s"
+        % (
+            "type",
+            "elements",
+            "seconds",
+            "elements/s",
+            "orm calls/el",
+            "queries/el",
+            "peak MB",
+            "errors",
+        )
+    )
+    results = [
+        run(ordertype, int(scale), calls=args.calls, memory=not args.no_memory)
+        for ordertype in args.types.split(",")
+        for scale in args.scales.split(",")
+    ]
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
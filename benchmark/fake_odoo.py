@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+In-memory stand-in for the parts of Odoo used by the frePPLe connector.
+
+The records of every model are kept in a FakeTable as dictionaries in the
+format returned by read(): many2one fields hold [id, name] or False, and
+x2many fields hold a list of ids. The models support search with a domain,
+browse, read, create, write and unlink. The cursor only understands the
+queries for which a handler is registered on the database.
+
+Every search, read, create, write and query increments the sql_log_count of
+the cursor, which gives an estimate of the number of round trips the same
+code would make to the database. The database also counts the ORM calls
+per model and method, including the field accesses on records.
+"""
+
+import bisect
+import collections
+import contextlib
+import importlib.util
+import itertools
+import operator
+import re
+import sys
+import types
+from datetime import datetime
+
+
+class FakeTable(object):
+    """
+    Records of a single model, indexed by id.
+
+    The relations map a many2one field to its model, for dotted domains and
+    for the field access on records. The converters map a field to the
+    function converting the values written in it, eg float for quantities.
+    The defaults map a field to the function computing its value for a new
+    record from its id.
+
+    Equality searches on a field use an index, which is built at the first
+    search on that field and maintained afterwards.
+    """
+
+    def __init__(self, model, relations=None, converters=None, defaults=None):
+        self.model = model
+        self.relations = relations or {}
+        self.converters = converters or {}
+        self.defaults = defaults or {}
+        self.records = {}
+        # Names of the fields stored in any record
+        self.fields = set()
+        self.ids = []
+        self.indexes = {}
+        self.next_id = 1
+
+    def convert(self, vals):
+        return {
+            k: (self.converters[k](v) if k in self.converters and v else v)
+            for k, v in vals.items()
+        }
+
+    def insert(self, vals):
+        rec_id = vals.get("id", None) or self.next_id
+        self.next_id = max(self.next_id, rec_id + 1)
+        record = {k: f(rec_id) for k, f in self.defaults.items()}
+        record.update(self.convert(vals))
+        record["id"] = rec_id
+        if rec_id in self.records:
+            self.delete(rec_id)
+        if not self.ids or rec_id > self.ids[-1]:
+            self.ids.append(rec_id)
+        else:
+            bisect.insort(self.ids, rec_id)
+        self.records[rec_id] = record
+        self.fields.update(record)
+        for field, index in self.indexes.items():
+            index[_key(record.get(field, False))].append(rec_id)
+        return rec_id
+
+    def update(self, rec_id, vals):
+        vals = self.convert(vals)
+        record = self.records[rec_id]
+        for field, index in self.indexes.items():
+            if field in vals:
+                index[_key(record.get(field, False))].remove(rec_id)
+                index[_key(vals[field])].append(rec_id)
+        record.update(vals)
+        self.fields.update(vals)
+
+    def delete(self, rec_id):
+        record = self.records.pop(rec_id, None)
+        if record is not None:
+            del self.ids[bisect.bisect_left(self.ids, rec_id)]
+            for field, index in self.indexes.items():
+                index[_key(record.get(field, False))].remove(rec_id)
+
+    def index(self, field):
+        index = self.indexes.get(field, None)
+        if index is None:
+            index = self.indexes[field] = collections.defaultdict(list)
+            for rec_id in self.ids:
+                index[_key(self.records[rec_id].get(field, False))].append(rec_id)
+        return index
+
+
+class FakeDatabase(object):
+    """
+    A database with the tables of the models and the handlers of the SQL
+    queries. A handler is a function receiving the database and the query
+    parameters and returning a tuple with the column names and the rows.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tables = {}
+        self.raw = {}
+        self.queries = []
+        # Number of ORM calls per (model, method)
+        self.calls = collections.Counter()
+        self.register_query(
+            r"now\(\)", lambda db, params: (["now"], [(datetime.now(),)])
+        )
+        self.register_query(r"to_regclass", self.query_existing_tables)
+        self.register_query(r"max\(write_date\), count\(\*\)", self.query_fingerprint)
+
+    def table(self, model):
+        return self.tables[model]
+
+    def add_model(self, model, relations=None, converters=None, defaults=None):
+        self.tables[model] = FakeTable(model, relations, converters, defaults)
+        return self.tables[model]
+
+    def register_query(self, pattern, handler):
+        self.queries.append((re.compile(pattern, re.I | re.S), handler))
+
+    def table_name(self, name):
+        """
+        Returns the table of a model from the name of its SQL table.
+        """
+        for model, table in self.tables.items():
+            if model.replace(".", "_") == name:
+                return table
+        return None
+
+    def query_existing_tables(self, db, params):
+        return (
+            ["t"],
+            [
+                (t,)
+                for t in params[0]
+                if self.table_name(t) is not None or t in self.raw
+            ],
+        )
+
+    def query_fingerprint(self, db, params):
+        # Queries generated by exporter.table_fingerprint
+        query = self.last_query
+        rows = []
+        for name in re.findall(r"FROM (\w+)", query):
+            table = self.table_name(name)
+            if table is not None:
+                dates = [
+                    r["write_date"]
+                    for r in table.records.values()
+                    if r.get("write_date", None)
+                ]
+                rows.append((name, max(dates) if dates else None, len(table.ids)))
+            else:
+                rows.append((name, None, len(self.raw.get(name, []))))
+        return (["t", "max", "count"], rows)
+
+
+class FakeCursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.dbname = db.name
+        self.sql_log_count = 0
+        self.columns = []
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.sql_log_count += 1
+        self.db.last_query = query
+        for pattern, handler in self.db.queries:
+            if pattern.search(query):
+                columns, rows = handler(self.db, params or ())
+                self.columns = list(columns)
+                self.rows = iter(rows)
+                return
+        raise NotImplementedError("Query not supported by the fake cursor: %s" % query)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size):
+        return [i for _, i in zip(range(size), self.rows)]
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def dictfetchmany(self, size):
+        return [dict(zip(self.columns, i)) for i in self.fetchmany(size)]
+
+    def dictfetchall(self):
+        return [dict(zip(self.columns, i)) for i in self.fetchall()]
+
+    @property
+    def _cnx(self):
+        # Named cursors of the connection are plain cursors of the database
+        return self
+
+    def cursor(self, name=None):
+        return FakeCursor(self.db)
+
+    def close(self):
+        self.rows = iter(())
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def _value(value):
+    # The id of a many2one value, or the value itself
+    if isinstance(value, list) and len(value) == 2 and isinstance(value[0], int):
+        return value[0]
+    return value
+
+
+def _key(value):
+    # Index key of a value
+    value = _value(value)
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _like(value, pattern):
+    if not isinstance(value, str):
+        return False
+    return pattern.lower().strip("%") in value.lower()
+
+
+def _compare(op):
+    def compare(value, arg):
+        if value is None or value is False:
+            return False
+        if isinstance(arg, str) and isinstance(value, (int, float)):
+            # The database casts the argument to the type of the column
+            arg = float(arg)
+        return op(value, arg)
+
+    return compare
+
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+    "in": lambda value, arg: value in arg,
+    "not in": lambda value, arg: value not in arg,
+    ">": _compare(operator.gt),
+    ">=": _compare(operator.ge),
+    "<": _compare(operator.lt),
+    "<=": _compare(operator.le),
+    "like": _like,
+    "ilike": _like,
+    "=like": _like,
+    "=ilike": _like,
+}
+
+
+class FakeModel(object):
+    """
+    A recordset: a model and a list of ids.
+    """
+
+    def __init__(self, env, model, ids=()):
+        self.env = env
+        self._name = model
+        self.ids = list(ids)
+
+    @property
+    def _table(self):
+        return self.env.db.table(self._name)
+
+    @property
+    def _fields(self):
+        return dict.fromkeys(self._table.fields)
+
+    @property
+    def id(self):
+        return self.ids[0] if self.ids else False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def __iter__(self):
+        for i in self.ids:
+            yield FakeModel(self.env, self._name, [i])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        if isinstance(key, slice):
+            return FakeModel(self.env, self._name, self.ids[key])
+        return FakeModel(self.env, self._name, [self.ids[key]])
+
+    def __getattr__(self, field):
+        if field.startswith("_") or len(self.ids) != 1:
+            raise AttributeError(field)
+        self.env.db.calls[(self._name, "field")] += 1
+        record = self._table.records.get(self.ids[0], None)
+        if record is None or field not in record:
+            raise AttributeError(field)
+        value = record[field]
+        relation = self._table.relations.get(field, None)
+        if relation:
+            return FakeModel(self.env, relation, [_value(value)] if value else [])
+        return value
+
+    def __setattr__(self, field, value):
+        if field in ("env", "_name", "ids"):
+            object.__setattr__(self, field, value)
+        else:
+            # Assigning a field writes it
+            self.write({field: value})
+
+    def sudo(self, *args):
+        return self
+
+    def with_user(self, *args):
+        return self
+
+    def with_context(self, *args, **kwargs):
+        return self
+
+    def browse(self, ids):
+        self.env.db.calls[(self._name, "browse")] += 1
+        if isinstance(ids, int):
+            ids = [ids]
+        return FakeModel(self.env, self._name, ids or [])
+
+    def exists(self):
+        records = self._table.records
+        return FakeModel(self.env, self._name, [i for i in self.ids if i in records])
+
+    def invalidate_cache(self, fnames=None, ids=None):
+        pass
+
+    def get_value(self, record, path):
+        table = self._table
+        for field in path.split("."):
+            if record is None:
+                return False
+            value = record.get(field, False)
+            relation = table.relations.get(field, None)
+            if relation and field != path.rsplit(".", 1)[-1]:
+                table = self.env.db.table(relation)
+                record = table.records.get(value[0], None) if value else None
+            else:
+                return value
+        return False
+
+    def compile(self, domain):
+        """
+        Returns a function testing whether a record matches a domain in
+        Odoo's prefix notation.
+        """
+
+        def leaf(term):
+            path, op, arg = term
+            test = OPERATORS[op]
+            if path == "id":
+                return lambda record: test(record["id"], arg)
+            return lambda record: test(_value(self.get_value(record, path)), arg)
+
+        def parse(pos):
+            token = domain[pos]
+            if token == "|":
+                first, pos = parse(pos + 1)
+                second, pos = parse(pos)
+                return (lambda record: first(record) or second(record)), pos
+            if token == "&":
+                first, pos = parse(pos + 1)
+                second, pos = parse(pos)
+                return (lambda record: first(record) and second(record)), pos
+            if token == "!":
+                first, pos = parse(pos + 1)
+                return (lambda record: not first(record)), pos
+            return leaf(token), pos + 1
+
+        terms = []
+        pos = 0
+        while pos < len(domain):
+            term, pos = parse(pos)
+            terms.append(term)
+        return lambda record: all(term(record) for term in terms)
+
+    def sort_key(self, field):
+        def key(record):
+            value = _value(record.get(field, None))
+            return (value is None or value is False, value or 0)
+
+        return key
+
+    def search(self, domain=[], order=None, limit=None, offset=0, count=False):
+        self.env.cr.sql_log_count += 1
+        self.env.db.calls[(self._name, "search")] += 1
+        table = self._table
+        domain = list(domain)
+        candidates = table.ids
+        start = 0
+        if all(isinstance(i, (tuple, list)) for i in domain):
+            # Use the index of a field compared for equality
+            for path, op, arg in domain:
+                if op == "=" and "." not in path and path != "id":
+                    candidates = sorted(table.index(path).get(_key(arg), []))
+                    break
+            # Start from the lower bound of the ids, to keep paging by id cheap
+            for path, op, arg in domain:
+                if path == "id" and op in (">", ">="):
+                    start = max(
+                        start,
+                        (bisect.bisect_right if op == ">" else bisect.bisect_left)(
+                            candidates, arg
+                        ),
+                    )
+        test = self.compile(domain)
+        by_id = not order or order.strip() in ("id", "id asc")
+        result = []
+        for i in itertools.islice(candidates, start, None):
+            record = table.records[i]
+            if test(record):
+                result.append(record)
+                if by_id and limit and len(result) >= offset + limit:
+                    break
+        if not by_id:
+            for term in reversed(order.split(",")):
+                parts = term.split()
+                result.sort(
+                    key=self.sort_key(parts[0]),
+                    reverse=len(parts) > 1 and parts[1].lower() == "desc",
+                )
+        if offset:
+            result = result[offset:]
+        if limit:
+            result = result[:limit]
+        if count:
+            return len(result)
+        return FakeModel(self.env, self._name, [r["id"] for r in result])
+
+    def search_count(self, domain=[]):
+        return self.search(domain, count=True)
+
+    def read(self, fields=None):
+        self.env.cr.sql_log_count += 1
+        self.env.db.calls[(self._name, "read")] += 1
+        records = self._table.records
+        result = []
+        for i in self.ids:
+            record = records.get(i, None)
+            if record is None:
+                continue
+            if fields:
+                row = {f: record.get(f, False) for f in fields}
+                row["id"] = i
+            else:
+                row = dict(record)
+            result.append(row)
+        return result
+
+    def create(self, vals):
+        self.env.cr.sql_log_count += 1
+        self.env.db.calls[(self._name, "create")] += 1
+        if isinstance(vals, list):
+            return FakeModel(
+                self.env, self._name, [self._table.insert(i) for i in vals]
+            )
+        return FakeModel(self.env, self._name, [self._table.insert(vals)])
+
+    def write(self, vals):
+        self.env.cr.sql_log_count += 1
+        self.env.db.calls[(self._name, "write")] += 1
+        for i in self.ids:
+            self._table.update(i, vals)
+        return True
+
+    def unlink(self):
+        self.env.cr.sql_log_count += 1
+        self.env.db.calls[(self._name, "unlink")] += 1
+        for i in self.ids:
+            self._table.delete(i)
+        return True
+
+
+class FakeEnv(object):
+    def __init__(self, db, uid=1, context=None, cr=None):
+        self.db = db
+        self.cr = cr or FakeCursor(db)
+        self.uid = uid
+        self.context = context or {}
+
+    def __getitem__(self, model):
+        self.db.table(model)
+        return FakeModel(self, model)
+
+    def __contains__(self, model):
+        return model in self.db.tables
+
+    def __call__(self, cr=None, user=None, context=None):
+        return FakeEnv(
+            self.db,
+            self.uid,
+            self.context if context is None else context,
+            cr or self.cr,
+        )
+
+    @property
+    def user(self):
+        return FakeModel(self, "res.users", [self.uid])
+
+    def invalidate_all(self):
+        pass
+
+
+class FakeHttpRequest(object):
+    def __init__(self, files=None, form=None):
+        self.files = files or {}
+        self.form = form or {}
+
+
+class FakeRequest(object):
+    """
+    The attributes of odoo.http.request used by the connector.
+    """
+
+    def __init__(self, env, files=None, form=None):
+        self.env = env
+        self.uid = env.uid
+        self.httprequest = FakeHttpRequest(files, form)
+
+
+def install(db):
+    """
+    Registers a fake odoo package in sys.modules, in which the registry of
+    every database name returns the given database.
+    """
+    odoo = types.ModuleType("odoo")
+    api = types.ModuleType("odoo.api")
+
+    class Environment(FakeEnv):
+        @staticmethod
+        @contextlib.contextmanager
+        def manage():
+            yield
+
+        def __init__(self, cr, uid, context):
+            super().__init__(db, uid, context, cr)
+
+    class Registry(object):
+        def __init__(self, name):
+            self.name = name
+
+        def cursor(self):
+            return FakeCursor(db)
+
+    api.Environment = Environment
+    odoo.api = api
+    odoo.registry = Registry
+    sys.modules["odoo"] = odoo
+    sys.modules["odoo.api"] = api
+    return odoo
+
+
+def load_module(name, path):
+    """
+    Imports a module of the connector from its file, without importing the
+    frepple addon package itself.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -14,6 +14,8 @@
         "views/frepple_data.xml",
         "views/res_config_settings_views.xml",
         "security/frepple_security.xml",
+        "security/ir.model.access.csv",
+        "data/frepple_cron.xml",
     ],
     "demo": ["data/demo.xml"],
     "test": [],
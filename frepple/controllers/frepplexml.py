@@ -17,11 +17,16 @@
 #
 
 import base64
+import json
 import logging
 import odoo
 import os
+import time
+import zipfile
+import zlib
 from pathlib import Path
 from tempfile import NamedTemporaryFile
+from types import SimpleNamespace
 from werkzeug.exceptions import MethodNotAllowed, InternalServerError
 from werkzeug.wrappers import Response
 
@@ -29,6 +34,9 @@ from odoo import http
 from odoo.addons.web.controllers.main import db_monodb
 from odoo.addons.frepple.controllers.outbound import exporter
 from odoo.addons.frepple.controllers.inbound import importer
+from odoo.addons.frepple.controllers.jobs import ExportJob
+from odoo.addons.frepple.controllers.snapshots import ExportSnapshot
+from odoo.addons.frepple.controllers.singleflight import SingleFlight, cleanup
 
 logger = logging.getLogger(__name__)
 
@@ -39,8 +47,76 @@ except Exception:
         "PyJWT module has not been installed. Please install the library from https://pypi.python.org/pypi/PyJWT"
     )
 
+# Zstandard compression is optional: without the library we only offer gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compressor(object):
+    """
+    Incremental compression of the export with gzip or zstd.
+
+    The sync method flushes the compressed data produced so far, such that
+    the client can decompress a streamed response while it is being received.
+    """
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self.obj = zstandard.ZstdCompressor(
+                level=3 if level is None else level
+            ).compressobj()
+        else:
+            # wbits 31 selects the gzip container
+            self.obj = zlib.compressobj(
+                6 if level is None else level, zlib.DEFLATED, 31
+            )
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def sync(self):
+        if self.encoding == "zstd":
+            return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class ArchiveWriter(object):
+    """
+    Collects the bytes a ZipFile writes, such that the archive can be sent
+    while it is being generated. As the object can't seek, the zip file is
+    written sequentially.
+    """
+
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        return data
+
 
 class XMLController(odoo.http.Controller):
+    # Buffer size of the spool file
+    spool_buffer = 1 << 20
+
+    # Default number of seconds spooled exports and finished background jobs
+    # are kept, overridden by the system parameter frepple.retention
+    retention = 3600
+
     def authenticate(self, req, database, language=None):
         """
         Implements HTTP basic authentication.
@@ -63,6 +139,248 @@ class XMLController(odoo.http.Controller):
             req.session.context["lang"] = language
         return uid
 
+    def get_param(self, req, kwargs, name, default=None):
+        """
+        Returns an export setting from the URL arguments. When it isn't
+        passed, the system parameter frepple.<name> is used.
+        """
+        value = kwargs.get(name, None)
+        if value is None:
+            value = (
+                req.env["ir.config_parameter"]
+                .sudo()
+                .get_param("frepple.%s" % name, default)
+            )
+        return value
+
+    def get_parallel(self, kwargs):
+        """
+        Returns the number of sections generated at the same time. Every
+        section uses a database connection of its own: the number is limited
+        to the number of CPUs and to the connections the server can open
+        besides the one of the request.
+        """
+        parallel = int(kwargs.get("parallel", 0))
+        if parallel < 0:
+            raise ValueError("Negative parallel argument")
+        return max(
+            0,
+            min(
+                parallel,
+                os.cpu_count() or 1,
+                odoo.tools.config["db_maxconn"] - 1,
+            ),
+        )
+
+    def get_encoding(self, req):
+        """
+        Picks the compression for the response from the Accept-Encoding header.
+        Returns None when the client doesn't accept any compression we support.
+        """
+        supported = ["zstd", "gzip"] if zstandard else ["gzip"]
+        return req.httprequest.accept_encodings.best_match(supported)
+
+    def compress(self, chunks, encoding, level):
+        """
+        Compresses a stream of encoded chunks on the fly.
+        """
+        compressor = Compressor(encoding, level)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.sync()
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def generate(self, xp, companies, chunk_size):
+        """
+        Returns the encoded chunks of the export. For multiple companies this
+        is a zip archive with a document per company.
+        """
+        if len(companies) < 2:
+            for i in xp.run_chunked(chunk_size):
+                yield i.encode("utf-8")
+            return
+        out = ArchiveWriter()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+            for company, chunks in xp.run_companies(companies, chunk_size):
+                name = "%s.%s" % (
+                    (company or "export").replace("/", "_"),
+                    xp.serializer.extension,
+                )
+                with archive.open(name, "w", force_zip64=True) as f:
+                    for i in chunks:
+                        f.write(i.encode("utf-8"))
+                        data = out.read()
+                        if data:
+                            yield data
+        yield out.read()
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(self.spool_buffer)
+                if not data:
+                    break
+                yield data
+
+    def send_snapshot(self, req, kwargs, latest):
+        """
+        Returns a snapshot generated by the scheduled action, or a 304 status
+        when the client has the same version already.
+        """
+        if req.httprequest.if_none_match.contains(latest["etag"]):
+            res = Response(status=304)
+        else:
+            encoding = self.get_encoding(req)
+            if encoding:
+                level = self.get_param(req, kwargs, "compresslevel")
+                res = Response(
+                    self.compress(
+                        self.read_file(latest["file"]),
+                        encoding,
+                        int(level) if level else None,
+                    ),
+                    mimetype=exporter.serializers["xml"].mimetype,
+                    direct_passthrough=True,
+                )
+                res.headers["Content-Encoding"] = encoding
+            else:
+                res = http.send_file(
+                    latest["file"],
+                    mimetype=exporter.serializers["xml"].mimetype,
+                    as_attachment=False,
+                )
+        res.set_etag(latest["etag"])
+        res.headers["Cache-Control"] = "no-cache"
+        res.headers["Vary"] = "Accept-Encoding"
+        return res
+
+    def spool(self, f, chunks, encoding, level):
+        """
+        Writes the export to a file, compressed if an encoding is given.
+        """
+        compressor = Compressor(encoding, level) if encoding else None
+        for i in chunks:
+            if compressor:
+                f.write(compressor.compress(i))
+            else:
+                f.write(i)
+        if compressor:
+            f.write(compressor.flush())
+
+    def spool_file(self, folder, chunks, encoding, level):
+        """
+        Writes the export to a new file in the folder, and returns its name.
+        """
+        with NamedTemporaryFile(
+            mode="w+b",
+            buffering=self.spool_buffer,
+            delete=False,
+            dir=folder,
+        ) as tmpfile:
+            try:
+                self.spool(tmpfile, chunks, encoding, level)
+            except Exception:
+                os.remove(tmpfile.name)
+                raise
+            return tmpfile.name
+
+    def enqueue(self, database, uid, context, companies, options, **kwargs):
+        """
+        Queues the export for the scheduled action, and returns the job id.
+        The options are the arguments of the exporter.
+        """
+        job = ExportJob.create(
+            database,
+            uid,
+            len([i for i in exporter.sections if options["mode"] in i[2]])
+            * len(companies),
+            companies=companies,
+            mode=options["mode"],
+            context=context,
+            options=options,
+            **kwargs
+        )
+        url = "/frepple/xml/job/%s" % job.id
+        return Response(
+            json.dumps({"job": job.id, "status": "queued", "url": url}),
+            202,
+            mimetype="application/json",
+            headers=[("Location", url)],
+        )
+
+    def run_job(self, job, status):
+        """
+        Generates the export of a background job as the user that requested
+        it. Called from the scheduled action.
+        """
+        with odoo.registry(status["database"]).cursor() as cr:
+            env = odoo.api.Environment(cr, status["uid"], status["context"])
+            # The exporter only uses the environment of the request
+            xp = exporter(
+                SimpleNamespace(env=env),
+                uid=status["uid"],
+                database=status["database"],
+                company=status["companies"][0],
+                **status["options"]
+            )
+            xp.progress = job.progress
+            with open(job.result_file, "wb", buffering=self.spool_buffer) as f:
+                self.spool(
+                    f,
+                    self.generate(xp, status["companies"], status["chunk_size"]),
+                    status["encoding"],
+                    status["level"],
+                )
+
+    def get_job(self, req, job_id, kwargs):
+        """
+        Authenticates the request and returns the job and its status, or the
+        response to send when that fails.
+        """
+        database = kwargs.get("database", None)
+        if not database:
+            database = db_monodb()
+        req.session.db = database
+        try:
+            uid = self.authenticate(req, database, kwargs.get("language", None))
+        except Exception as e:
+            logger.warning("Failed login attempt: %s" % e)
+            return (
+                None,
+                Response(
+                    "Login with Odoo user name and password",
+                    401,
+                    headers=[("WWW-Authenticate", 'Basic realm="odoo"')],
+                ),
+            )
+        try:
+            job = ExportJob(job_id)
+        except ValueError:
+            return None, Response("Unknown job", 404)
+        status = job.read()
+        if not status or status["uid"] != uid or status["database"] != database:
+            return None, Response("Unknown job", 404)
+        return job, status
+
+    def stream(self, xp, database, uid, context, companies, chunk_size):
+        """
+        Generates the export while it is being sent to the client.
+
+        The cursor of the request is already closed when the response body is
+        sent. The export therefore runs on a dedicated cursor, which is
+        committed only when the complete document has been generated.
+        """
+        with odoo.api.Environment.manage():
+            with odoo.registry(database).cursor() as cr:
+                xp.set_env(odoo.api.Environment(cr, uid, context))
+                try:
+                    for i in self.generate(xp, companies, chunk_size):
+                        yield i
+                except Exception:
+                    logger.exception("Error streaming frePPLe XML data")
+                    raise
+
     @odoo.http.route(
         "/frepple/xml", type="http", auth="none", methods=["POST", "GET"], csrf=False
     )
@@ -90,41 +408,166 @@ class XMLController(odoo.http.Controller):
             # from frePPLe and not from somebody else.
 
             # Generate data
+            output_format = kwargs.get("format", "xml")
+            if output_format not in exporter.serializers:
+                return Response("Invalid format argument", 400)
+            # Passing the company argument multiple times exports all of them
+            # in a single pass, returned as a zip archive
+            companies = req.httprequest.args.getlist("company") or [
+                kwargs.get("company", None)
+            ]
+            if len(companies) > 1 and kwargs.get("mode", "1") == "3":
+                return Response("Mode 3 exports a single company", 400)
+            try:
+                parallel = self.get_parallel(kwargs)
+            except ValueError:
+                return Response("Invalid parallel argument", 400)
+
             try:
+                pagesize = self.get_param(req, kwargs, "pagesize")
+                calendar_horizon = self.get_param(req, kwargs, "calendar_horizon")
+                options = {
+                    "mode": int(kwargs.get("mode", 1)),
+                    "use_cache": kwargs.get("cache", "1") != "0",
+                    "parallel": parallel,
+                    "sql_readers": kwargs.get("sql", "0") == "1",
+                    "pagesize": int(pagesize) if pagesize else None,
+                    "calendar_horizon": (
+                        int(calendar_horizon) if calendar_horizon else None
+                    ),
+                    "format": output_format,
+                    "profile_memory": kwargs.get("tracemalloc", "0") == "1",
+                }
+
+                # Compress the response if the client accepts it
+                encoding = self.get_encoding(req)
+                level = self.get_param(req, kwargs, "compresslevel")
+                level = int(level) if level else None
+                chunk_size = self.get_param(req, kwargs, "chunksize")
+                chunk_size = int(chunk_size) if chunk_size else None
+                if len(companies) > 1:
+                    # The archive is compressed already
+                    encoding = None
+                    mimetype = "application/zip"
+                else:
+                    mimetype = exporter.serializers[output_format].mimetype
+
+                if kwargs.get("async", "0") == "1":
+                    # Generate the data in the background
+                    return self.enqueue(
+                        database,
+                        uid,
+                        {
+                            k: v
+                            for k, v in req.env.context.items()
+                            if k in ("lang", "tz")
+                        },
+                        companies,
+                        options,
+                        chunk_size=chunk_size,
+                        encoding=encoding,
+                        level=level,
+                        mimetype=mimetype,
+                    )
+
                 xp = exporter(
-                    req,
-                    uid=uid,
-                    database=database,
-                    company=kwargs.get("company", None),
-                    mode=int(kwargs.get("mode", 1)),
+                    req, uid=uid, database=database, company=companies[0], **options
                 )
 
-                # last empty double quote is to let python understand frepple is a folder.
-                xml_folder = os.path.join(str(Path.home()), "logs", "frepple", "")
-                os.makedirs(os.path.dirname(xml_folder), exist_ok=True)
+                # Serve the snapshot generated by the scheduled action when it
+                # is recent enough and was generated for the same user and
+                # settings. The snapshot_age setting is its maximum age in
+                # seconds, and the argument snapshot=0 forces a new export.
+                snapshot_age = self.get_param(req, kwargs, "snapshot_age")
+                if (
+                    snapshot_age
+                    and kwargs.get("snapshot", "1") != "0"
+                    and output_format == "xml"
+                    and len(companies) == 1
+                    and xp.mode != 3
+                ):
+                    latest = ExportSnapshot(xp).latest()
+                    if latest and time.time() - latest["created"] <= int(snapshot_age):
+                        return self.send_snapshot(req, kwargs, latest)
 
-                # delete any old xml file in that folder
-                for file_name in os.listdir(xml_folder):
-                    # construct full file path
-                    file = xml_folder + file_name
-                    if os.path.isfile(file):
-                        os.remove(file)
+                if kwargs.get("stream", "0") == "1":
+                    # Send the data while it is being generated
+                    body = self.stream(
+                        xp,
+                        database,
+                        uid,
+                        dict(req.env.context),
+                        companies,
+                        chunk_size,
+                    )
+                    headers = [
+                        ("Cache-Control", "no-cache, no-store, must-revalidate"),
+                        ("Pragma", "no-cache"),
+                        ("Expires", "0"),
+                        ("Vary", "Accept-Encoding"),
+                    ]
+                    if encoding:
+                        body = self.compress(body, encoding, level)
+                        headers.append(("Content-Encoding", encoding))
+                    return Response(
+                        body,
+                        mimetype=mimetype,
+                        headers=headers,
+                        direct_passthrough=True,
+                    )
+
+                # Every export is spooled to a file of its own. Files are
+                # removed when they are older than the retention period, such
+                # that concurrent requests don't remove each other's output.
+                xml_folder = os.path.join(str(Path.home()), "logs", "frepple")
+                os.makedirs(xml_folder, exist_ok=True)
+                retention = (
+                    req.env["ir.config_parameter"].sudo().get_param("frepple.retention")
+                )
+                retention = int(retention) if retention else self.retention
+                cleanup(xml_folder, retention)
+                ExportJob.cleanup(retention)
+                SingleFlight.cleanup(retention)
+                timeout = (
+                    req.env["ir.config_parameter"]
+                    .sudo()
+                    .get_param("frepple.wait_timeout")
+                )
 
-                with NamedTemporaryFile(
-                    mode="w+t", delete=False, dir=xml_folder
-                ) as tmpfile:
-                    for i in xp.run():
-                        tmpfile.write(i)
-                    filename = tmpfile.name
+                # Identical requests running at the same time share the export.
+                # A request waits at most frepple.wait_timeout seconds for it.
+                filename = SingleFlight.run(
+                    (
+                        database,
+                        uid,
+                        companies,
+                        sorted((k, v) for k, v in kwargs.items() if k != "company"),
+                        encoding,
+                        level,
+                        chunk_size,
+                        pagesize,
+                        calendar_horizon,
+                    ),
+                    lambda: self.spool_file(
+                        xml_folder,
+                        self.generate(xp, companies, chunk_size),
+                        encoding,
+                        level,
+                    ),
+                    int(timeout) if timeout else None,
+                )
 
                 res = http.send_file(
                     filename,
-                    mimetype="application/xml;charset=utf8",
+                    mimetype=mimetype,
                     as_attachment=False,
                 )
                 res.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
                 res.headers["Pragma"] = "no-cache"
                 res.headers["Expires"] = "0"
+                res.headers["Vary"] = "Accept-Encoding"
+                if encoding:
+                    res.headers["Content-Encoding"] = encoding
                 return res
 
             except Exception as e:
@@ -195,3 +638,59 @@ class XMLController(odoo.http.Controller):
                 )
         else:
             raise MethodNotAllowed("Only GET and POST requests are accepted")
+
+    @odoo.http.route(
+        "/frepple/xml/job/<string:job_id>",
+        type="http",
+        auth="none",
+        methods=["GET"],
+        csrf=False,
+    )
+    def job_status(self, job_id, **kwargs):
+        """
+        Returns the status of a background export, with the progress of every
+        section.
+        """
+        job, status = self.get_job(odoo.http.request, job_id, kwargs)
+        if not job:
+            return status
+        status["url"] = "/frepple/xml/job/%s/result" % job.id
+        for key in ("uid", "host", "pid", "level", "context", "options"):
+            status.pop(key, None)
+        return Response(
+            json.dumps(status),
+            mimetype="application/json",
+            headers=[("Cache-Control", "no-cache, no-store, must-revalidate")],
+        )
+
+    @odoo.http.route(
+        "/frepple/xml/job/<string:job_id>/result",
+        type="http",
+        auth="none",
+        methods=["GET"],
+        csrf=False,
+    )
+    def job_result(self, job_id, **kwargs):
+        """
+        Returns the file generated by a background export.
+        """
+        job, status = self.get_job(odoo.http.request, job_id, kwargs)
+        if not job:
+            return status
+        if status["status"] != "done":
+            return Response(
+                json.dumps({"job": job.id, "status": status["status"]}),
+                409,
+                mimetype="application/json",
+            )
+        res = http.send_file(
+            job.result_file,
+            mimetype=status["mimetype"],
+            as_attachment=False,
+        )
+        res.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        res.headers["Pragma"] = "no-cache"
+        res.headers["Expires"] = "0"
+        if status["encoding"]:
+            res.headers["Content-Encoding"] = status["encoding"]
+        return res
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class ExportJob(object):
+    """
+    An export generated in the background.
+
+    Every job has a folder with a status file and, when it is finished, the
+    result file. The status is kept on disk, such that it can be polled from
+    any Odoo worker process:
+      - status: queued, running, done or failed
+      - sections: the progress of every section, per company
+      - error: the error message of a failed export
+      - warning: set when the limits of the cron workers can stop the job
+
+    The request only queues the job with the settings of the export. The
+    scheduled action "frePPLe: run export jobs" generates it, outside the
+    HTTP worker whose time and memory limits would stop a long export. The
+    cron workers have limits of their own, see frepple.export.job. When
+    the process running a job dies, the job is recorded as failed the next
+    time its status is read.
+    """
+
+    # Folder with a subfolder per job
+    folder = os.path.join(str(Path.home()), "logs", "frepple", "jobs")
+
+    # Serializes the status updates of the jobs of this process
+    lock = threading.Lock()
+
+    def __init__(self, job_id):
+        if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+            raise ValueError("Invalid job id")
+        self.id = job_id
+        self.path = os.path.join(self.folder, job_id)
+        self.status_file = os.path.join(self.path, "status.json")
+
+    @classmethod
+    def create(cls, database, uid, total, **values):
+        """
+        Registers a new job. The total is the number of sections the export
+        will generate.
+        """
+        job = cls(uuid.uuid4().hex)
+        os.makedirs(job.path, exist_ok=True)
+        status = {
+            "id": job.id,
+            "status": "queued",
+            "database": database,
+            "uid": uid,
+            "host": None,
+            "pid": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "total": total,
+            "done": 0,
+            "sections": [],
+            "error": None,
+        }
+        status.update(values)
+        job.write(status)
+        return job
+
+    @classmethod
+    def all(cls):
+        """
+        Returns all jobs with their status, oldest first.
+        """
+        try:
+            names = os.listdir(cls.folder)
+        except OSError:
+            return []
+        jobs = []
+        for name in names:
+            try:
+                job = cls(name)
+            except ValueError:
+                continue
+            status = job.read()
+            if status:
+                jobs.append((job, status))
+        jobs.sort(key=lambda i: i[1]["created"])
+        return jobs
+
+    @classmethod
+    def queued(cls, database):
+        """
+        Returns the jobs of a database waiting to be generated, oldest first.
+        """
+        return [
+            job
+            for job, status in cls.all()
+            if status["status"] == "queued" and status["database"] == database
+        ]
+
+    @classmethod
+    def cleanup(cls, retention):
+        """
+        Removes the jobs that finished longer than the retention period in
+        seconds ago. Jobs still queued after the retention period are failed:
+        the scheduled action isn't running.
+        """
+        limit = time.time() - retention
+        for job, status in cls.all():
+            if status["status"] == "queued" and status["created"] < limit:
+                job.update(
+                    status="failed",
+                    finished=time.time(),
+                    error="The job wasn't started: check the scheduled action "
+                    "frePPLe: run export jobs",
+                )
+            elif status["finished"] and status["finished"] < limit:
+                shutil.rmtree(job.path, ignore_errors=True)
+
+    def read(self):
+        """
+        Returns the status of the job, or None if the job doesn't exist.
+        """
+        try:
+            with open(self.status_file, "r") as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if status["status"] == "running" and not self.alive(status):
+            # Recorded, such that the job is removed after the retention
+            # period
+            status["status"] = "failed"
+            status["finished"] = time.time()
+            status["error"] = "The process generating the export has stopped"
+            self.write(status)
+        return status
+
+    def write(self, status):
+        # Replacing the file makes sure readers never see a partial status
+        tmp = "%s.%s.%s" % (self.status_file, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp, self.status_file)
+
+    def update(self, **values):
+        with self.lock:
+            status = self.read()
+            status.update(values)
+            self.write(status)
+
+    def alive(self, status):
+        """
+        Checks whether the process running the job still exists. Processes of
+        other servers are assumed to be alive.
+        """
+        if status["host"] != socket.gethostname():
+            return True
+        try:
+            os.kill(status["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @property
+    def result_file(self):
+        return os.path.join(self.path, "result")
+
+    def progress(self, company, section, stats):
+        """
+        Records the start and the end of a section, as the progress function
+        of the exporter.
+        """
+        with self.lock:
+            status = self.read()
+            if stats is None:
+                status["sections"].append(
+                    {
+                        "company": company,
+                        "section": section,
+                        "status": "running",
+                        "started": time.time(),
+                    }
+                )
+            else:
+                for i in reversed(status["sections"]):
+                    if i["company"] == company and i["section"] == section:
+                        i["status"] = "done"
+                        i["finished"] = time.time()
+                        i.update(stats)
+                        break
+                status["done"] += 1
+            self.write(status)
+
+    def claim(self):
+        """
+        Reserves the job for this process. Returns False when another process
+        claimed it already.
+        """
+        try:
+            os.close(
+                os.open(os.path.join(self.path, "claimed"), os.O_CREAT | os.O_EXCL)
+            )
+        except FileExistsError:
+            return False
+        return True
+
+    def run(self, function):
+        """
+        Generates the export with the function, which is passed the job and
+        its status, and returns when the result file is written. Errors are
+        recorded in the status of the job.
+        """
+        self.update(
+            status="running",
+            started=time.time(),
+            host=socket.gethostname(),
+            pid=os.getpid(),
+        )
+        try:
+            function(self, self.read())
+            self.update(status="done", finished=time.time())
+        except Exception as e:
+            logger.exception("Error in frePPLe export job %s" % self.id)
+            self.update(status="failed", finished=time.time(), error=str(e))
@@ -15,23 +15,84 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import bisect
+import copy
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 from xml.sax.saxutils import quoteattr as quoteattr_generic
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import pytz
 from pytz import timezone
 import odoo
 
 logger = logging.getLogger(__name__)
 
+# Cache of exported sections, shared by all requests handled by this process.
+# The key is a tuple (database, user, language, company, section): the record
+# rules of the user filter the data, and names are translated in the language.
+# The value is a tuple with the fingerprint of the source data, the XML
+# fragment, the attributes the section leaves on the exporter for the sections
+# that follow and the records it registered for the watermark bookkeeping.
+fragment_cache = {}
+fragment_cache_lock = threading.Lock()
 
-def quoteattr(str):
+# Hit and miss statistics of the fragment cache, per section. The bytes
+# counter is the size of the fragments served from the cache.
+fragment_cache_stats = {}
+
+# Cache of the location-to-warehouse mapping. The key is a tuple (database,
+# user, company), since the record rules of the user filter the locations.
+# The value is a tuple with the fingerprint of the location and warehouse
+# tables and the mapping itself.
+location_cache = {}
+location_cache_lock = threading.Lock()
+
+
+def peek(iterable):
+    """
+    Returns None when an iterable is empty, and otherwise an iterator
+    over all its elements.
+    """
+    iterator = iter(iterable)
+    for first in iterator:
+        return itertools.chain((first,), iterator)
+    return None
+
+
+# Characters for which an attribute value needs more than the double quotes
+quoteattr_special = frozenset('&<>"\n\r\t')
+
+
+@functools.lru_cache(maxsize=65536)
+def quoteattr_memo(str):
     return quoteattr_generic(str.encode(encoding="UTF-8", errors="ignore").decode())
 
 
+def quoteattr(str):
+    if str.isascii() and quoteattr_special.isdisjoint(str):
+        return '"%s"' % str
+    return quoteattr_memo(str)
+
+
 class Odoo_generator:
-    def __init__(self, env):
+    # Number of records read per query
+    pagesize = 1000
+
+    def __init__(self, env, pagesize=None):
         self.env = env
+        if pagesize:
+            self.pagesize = pagesize
+        # Number of records read
+        self.rows = 0
 
     def setContext(self, **kwargs):
         t = dict(self.env.context)
@@ -47,12 +108,43 @@ class Odoo_generator:
         return None
 
     def getData(self, model, search=[], order=None, fields=[], ids=None):
-        if ids is not None:
-            return self.env[model].browse(ids).read(fields) if ids else []
-        if order:
-            return self.env[model].search(search, order=order).read(fields)
+        """
+        Generator over the records of a model, read one page at a time.
+
+        Without an explicit order the pages are selected with "id > last id"
+        rather than with an offset, so a page deep in a large table is as fast
+        to read as the first one. The records are then returned in the order
+        of their id, not in the default order of the model. The sql_* readers
+        of the exporter use the same order. Callers that depend on the order,
+        like the priorities of the calendar buckets, sort the records.
+        When an order or a list of ids is given, the ids are retrieved once
+        and the records are read in slices.
+        The records of a page are evicted from the cache once they are read.
+        """
+        m = self.env[model]
+        if ids is None and not order:
+            last_id = 0
+            while True:
+                recs = m.search(
+                    list(search) + [("id", ">", last_id)],
+                    order="id",
+                    limit=self.pagesize,
+                )
+                self.rows += len(recs)
+                for i in recs.read(fields):
+                    yield i
+                if len(recs) < self.pagesize:
+                    return
+                last_id = recs.ids[-1]
+                recs.invalidate_cache(ids=recs.ids)
         else:
-            return self.env[model].search(search).read(fields)
+            recs = m.browse(ids) if ids is not None else m.search(search, order=order)
+            for start in range(0, len(recs), self.pagesize):
+                page = recs[start : start + self.pagesize]
+                self.rows += len(page)
+                for i in page.read(fields):
+                    yield i
+                page.invalidate_cache(ids=page.ids)
 
 
 def _log_logging(env, message, function_name, path):
@@ -70,11 +162,400 @@ def _log_logging(env, message, function_name, path):
     )
 
 
+class DateFormatter(object):
+    """
+    Converts datetimes into the local time of a timezone and formats them in
+    the frePPLe format.
+
+    Timezones are built only once, and the UTC offset is computed only once
+    per timezone and day. On days with a daylight saving transition the
+    offset is computed for every datetime instead.
+    """
+
+    def __init__(self, default="UTC"):
+        self.default = default
+        self.timezones = {}
+        # Key is (timezone name, day ordinal), value the offset or None
+        self.offsets = {}
+
+    def get_timezone(self, tmzone=None):
+        tmzone = tmzone or self.default
+        tz = self.timezones.get(tmzone, None)
+        if tz is None:
+            tz = self.timezones[tmzone] = timezone(tmzone)
+        return tz
+
+    def day_offset(self, tmzone, day):
+        """
+        Returns the UTC offset of a timezone on a day, or None when the offset
+        changes during that day.
+        """
+        tz = self.get_timezone(tmzone)
+        start = datetime(day.year, day.month, day.day)
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions:
+            i = bisect.bisect_right(transitions, start)
+            if i < len(transitions) and transitions[i] < start + timedelta(days=1):
+                return None
+        return pytz.utc.localize(start).astimezone(tz).utcoffset()
+
+    def format(self, d, tmzone=None):
+        """
+        Formats a datetime, a date or an iso formatted string. Naive values
+        are in the local time of the server, as datetime.astimezone assumes.
+        """
+        if not isinstance(d, datetime):
+            if isinstance(d, date):
+                d = datetime(d.year, d.month, d.day)
+            else:
+                d = datetime.fromisoformat(d)
+        return self.format_utc(d.astimezone(pytz.utc).replace(tzinfo=None), tmzone)
+
+    def format_utc(self, d, tmzone=None):
+        """
+        Formats a naive datetime in UTC, the way Odoo stores datetimes.
+        """
+        tmzone = tmzone or self.default
+        key = (tmzone, d.toordinal())
+        try:
+            offset = self.offsets[key]
+        except KeyError:
+            offset = self.offsets[key] = self.day_offset(tmzone, d)
+        if offset is None:
+            d = pytz.utc.localize(d).astimezone(self.get_timezone(tmzone))
+            return d.replace(tzinfo=None).isoformat(timespec="seconds")
+        return (d + offset).isoformat(timespec="seconds")
+
+
+class OperationRegistry(object):
+    """
+    The operations generated from the bills of material.
+
+    Every bom results in an operation per product variant, named
+    "<bom id> <item> @ <location>". For a bom with a routing that is exported
+    as a routing operation, the steps are suboperations named
+    "<operation> - <step> - <sequence>".
+
+    The registry maps the bom id and variant to the name, location and
+    produced quantity of the operation and its steps, and an operation name
+    back to the same information. It avoids building and parsing these names
+    in the sections that refer to the operations.
+    """
+
+    def __init__(self):
+        # Key is (bom id, product id)
+        self.operations = {}
+        # Key is the operation name
+        self.names = {}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, bom_id, product_id, item, location):
+        """
+        Registers the operation of a bom for a product variant, and returns it.
+        """
+        name = "%d %s @ %s" % (bom_id, item, location)
+        operation = {
+            "name": name,
+            "bom_id": bom_id,
+            "product_id": product_id,
+            "item": item,
+            "location": location,
+            "produced_qty": None,
+            "steps": [],
+        }
+        self.operations[(bom_id, product_id)] = operation
+        self.names[name] = operation
+        return operation
+
+    def add_step(self, operation, step, sequence):
+        """
+        Registers a routing step of an operation, and returns its name.
+        """
+        name = "%s - %s - %s" % (operation["name"], step, sequence)
+        operation["steps"].append(name)
+        self.names[name] = operation
+        return name
+
+    def get(self, bom_id, product_id):
+        """
+        Returns the operation of a bom for a product variant, or None when
+        the bom has no operation for the variant.
+        """
+        return self.operations.get((bom_id, product_id), None)
+
+    def lookup(self, name):
+        """
+        Returns the operation with a name, or the operation a step belongs to.
+        """
+        return self.names.get(name, None)
+
+
+class XMLSerializer(object):
+    """
+    Passes the XML document generated by the exporter unchanged.
+    """
+
+    mimetype = "application/xml;charset=utf8"
+    extension = "xml"
+
+    def feed(self, data):
+        return data
+
+    def close(self):
+        return ""
+
+
+class JSONSerializer(object):
+    """
+    Converts the XML document generated by the exporter into newline-delimited
+    JSON, with one record per entity in the same order as the XML.
+
+    The first record holds the attributes of the plan. Every other record
+    holds the name of the section (eg "items") and the tag of the entity
+    (eg "item"), its attributes, and its child elements as nested objects.
+    The elements listed in list_tags become a list of their children, even
+    when they are empty. When such an element appears several times, the
+    lists are joined.
+    """
+
+    mimetype = "application/x-ndjson;charset=utf8"
+    extension = "ndjson"
+
+    namespaces = {"{http://www.w3.org/2001/XMLSchema-instance}": "xsi:"}
+
+    # Elements within an entity holding a list of elements
+    list_tags = frozenset(
+        ("buckets", "itemsuppliers", "flows", "loads", "suboperations")
+    )
+
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.stack = []
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return self.records()
+
+    def close(self):
+        self.parser.close()
+        return self.records()
+
+    def records(self):
+        out = []
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                self.stack.append(elem)
+                if len(self.stack) == 1:
+                    record = {"tag": elem.tag}
+                    record.update(self.attributes(elem))
+                    out.append(json.dumps(record))
+                continue
+            self.stack.pop()
+            if len(self.stack) == 2:
+                record = {"section": self.stack[1].tag, "tag": elem.tag}
+                record.update(self.convert(elem))
+                out.append(json.dumps(record))
+                # Release the entities that are serialized
+                self.stack[1].remove(elem)
+            elif len(self.stack) == 1:
+                self.stack[0].remove(elem)
+        return "".join("%s\n" % i for i in out)
+
+    def attributes(self, elem):
+        result = {}
+        for key, value in elem.attrib.items():
+            for uri, prefix in self.namespaces.items():
+                if key.startswith(uri):
+                    key = prefix + key[len(uri) :]
+                    break
+            result[key] = value
+        return result
+
+    def convert(self, elem):
+        result = self.attributes(elem)
+        for child in elem:
+            if child.tag in self.list_tags:
+                result.setdefault(child.tag, []).extend(self.convert(i) for i in child)
+            elif child.tag in result:
+                raise ValueError(
+                    "Element %s appears several times in %s" % (child.tag, elem.tag)
+                )
+            else:
+                result[child.tag] = self.convert(child)
+        text = (elem.text or "").strip()
+        if text and not len(elem):
+            result["value"] = text
+        return result
+
+
 class exporter(object):
-    def __init__(self, req, uid, database=None, company=None, mode=1):
+    # Output formats, and the class serializing the XML document in them
+    serializers = {"xml": XMLSerializer, "json": JSONSerializer}
+
+    # Sections of the export, in the order they appear in the document.
+    # For each section we list:
+    #   - the method generating it
+    #   - a description for the log file
+    #   - the modes in which it is exported
+    #   - the sections that must be finished first, because they populate
+    #     the lookup data this section needs
+    # The sales orders are not exported in this implementation.
+    sections = (
+        ("export_calendar", "calendars", (1, 3), ()),
+        ("export_locations", "locations", (1, 2, 3), ()),
+        ("export_customers", "customers", (1, 2, 3), ()),
+        ("export_suppliers", "suppliers", (1, 3), ()),
+        ("export_workcenters", "workcenters", (1, 3), ()),
+        ("export_items", "products", (1, 2, 3), ()),
+        ("export_boms", "BOMs", (1, 3), ("export_locations", "export_items")),
+        ("export_purchaseorders", "purchase orders", (1, 3), ("export_items",)),
+        (
+            "export_manufacturingorders",
+            "manufacturing orders",
+            (1, 3),
+            ("export_locations", "export_items", "export_boms"),
+        ),
+        (
+            "export_onhand",
+            "quantities on-hand",
+            (1, 3),
+            ("export_locations", "export_items"),
+        ),
+    )
+
+    # Sections of which the output depends on the company settings, directly
+    # or through the sections they depend on. When several companies are
+    # exported in a single pass, only these sections are generated for every
+    # company. The others are generated once and shared by all documents.
+    company_sections = (
+        "export_locations",
+        "export_workcenters",
+        "export_boms",
+        "export_manufacturingorders",
+    )
+
+    # Minimum size (in characters) of the strings returned by run_chunked
+    chunk_size = 65536
+
+    # Tables read by the sections that aren't cacheable, for the fingerprint
+    # of the complete export
+    snapshot_tables = (
+        "res_company",
+        "res_partner",
+        "product_category",
+        "product_template",
+        "product_product",
+        "product_supplierinfo",
+        "stock_location_route",
+        "purchase_order",
+        "purchase_order_line",
+        "mrp_production",
+        "stock_quant",
+    )
+
+    # Sections that can be served from the fragment cache.
+    # For each section we list:
+    #   - the tables the section (indirectly) reads
+    #   - the attributes it populates for later sections
+    #   - the exporter settings that influence its output
+    #   - the entities it registers for the watermark bookkeeping
+    cacheable_sections = {
+        "export_calendar": (
+            (
+                "resource_calendar",
+                "resource_calendar_attendance",
+                "resource_calendar_leaves",
+            ),
+            (),
+            ("timezone", "calendar_horizon", "calendar_start"),
+            (),
+        ),
+        "export_locations": (
+            ("stock_warehouse", "stock_location"),
+            ("map_locations", "warehouses", "warehouse_views"),
+            ("calendar",),
+            (),
+        ),
+        "export_workcenters": (
+            ("mrp_workcenter", "resource_resource", "resource_calendar"),
+            ("map_workcenters",),
+            ("mfg_location",),
+            ("resource",),
+        ),
+        "export_boms": (
+            (
+                "mrp_bom",
+                "mrp_bom_line",
+                "mrp_subproduct",
+                "mrp_routing",
+                "mrp_routing_workcenter",
+                "mrp_workcenter",
+                "product_product",
+                "product_template",
+                "uom_uom",
+                "stock_location",
+                "stock_warehouse",
+            ),
+            ("operation_registry",),
+            ("manage_work_orders", "manufacturing_lead", "mfg_location"),
+            ("operation",),
+        ),
+    }
+
+    def __init__(
+        self,
+        req,
+        uid,
+        database=None,
+        company=None,
+        mode=1,
+        use_cache=True,
+        parallel=0,
+        sql_readers=False,
+        pagesize=None,
+        calendar_horizon=None,
+        format="xml",
+        profile_memory=False,
+        watermarks=True,
+    ):
         self.database = database
         self.company = company
-        self.generator = Odoo_generator(req.env)
+        self.serializer = self.serializers[format]
+        # Measure the peak memory allocated by each section with tracemalloc.
+        # This slows down the export considerably.
+        self.profile_memory = profile_memory
+        # Record the watermarks for a later incremental export. Exports that
+        # may never be loaded in frePPLe, such as snapshots, must not.
+        self.watermarks = watermarks
+        # Statistics of the sections generated by the last run
+        self.section_stats = []
+        # Function called at the start of every section with the company and
+        # the section, and at its end with the statistics of the section too.
+        # Used to report the progress of background exports.
+        self.progress = None
+        self.use_cache = use_cache
+        # Read the master data with SQL rather than with the ORM
+        self.sql_readers = sql_readers
+        # Number of worker threads generating sections at the same time.
+        # 0 or 1 generates all sections one after the other.
+        self.parallel = parallel
+        # Number of records read per query by the ORM readers
+        self.pagesize = pagesize
+        # Number of days for which two-week calendars are expanded into
+        # weekly buckets, counting from the start of the current week.
+        # None expands the complete validity of the calendar.
+        self.calendar_horizon = calendar_horizon
+        if calendar_horizon:
+            today = datetime.combine(datetime.now().date(), datetime.min.time())
+            self.calendar_start = today - timedelta(days=today.weekday())
+        else:
+            self.calendar_start = None
+        self.generator = Odoo_generator(req.env, pagesize)
         self.timezone = timezone
         if timezone:
             if timezone not in pytz.all_timezones:
@@ -92,6 +573,7 @@ class exporter(object):
             ):
                 self.timezone = i["tz"] or "UTC"
         self.timeformat = "%Y-%m-%dT%H:%M:%S"
+        self.dates = DateFormatter(self.timezone)
 
         # The mode argument defines different types of runs:
         #  - Mode 1:
@@ -101,6 +583,11 @@ class exporter(object):
         #    This mode returns data that is loaded that changes infrequently and
         #    can be transferred during automated scheduled runs at a quiet moment.
         #    Currently this mode transfers only closed sales orders.
+        #  - Mode 3:
+        #    Incremental version of mode 1. Only records created or modified since
+        #    the previous successful export of mode 1 or 3 are transferred, and
+        #    records that disappeared since then are sent with a removal action.
+        #    The bookkeeping is kept per company in frepple.export.watermark.
         #
         # Normally an Odoo object should be exported by only a single mode.
         # ==== Exporting a certain object with BOTH modes 1 and 2 will only create extra
@@ -113,7 +600,22 @@ class exporter(object):
         # Initialize an environment
         self.env = req.env
 
-    def run(self):
+    def set_env(self, env):
+        """
+        Binds the exporter to another environment.
+        Used when the export runs on a cursor other than the one of the request.
+        """
+        self.env = env
+        self.generator = Odoo_generator(env, self.pagesize)
+
+    def run(self, shared=None):
+        """
+        Generates the document of the company.
+
+        When exporting several companies, the same dictionary is passed as the
+        shared argument for all of them. The sections that don't depend on the
+        company are stored in it the first time and reused afterwards.
+        """
         # Check if we manage by work orders or manufacturing orders.
         self.manage_work_orders = False
         m = self.env["ir.model"]
@@ -123,7 +625,11 @@ class exporter(object):
 
         # Load some auxiliary data in memory
         self.load_company()
-        self.load_uom()
+        if not shared:
+            # Shared sections use the uom of the first company
+            self.load_uom()
+        self.load_watermarks()
+        self.section_stats = []
 
         # Header.
         # The source attribute is set to 'odoo_<mode>', such that all objects created or
@@ -137,60 +643,309 @@ class exporter(object):
         # If multiple types of an entity exists (eg operation_time_per,
         # operation_alternate, operation_alternate, etc) the reference would
         # automatically create an object, potentially of the wrong type.
-        logger.error("======= ==== Exporting calendars.")
-        # _log_logging(self.env, "==== Exporting calendars","frepple", "1")
-        if self.mode == 1:
-            for i in self.export_calendar():
-                yield i
-        # _log_logging(self.env, "==== Exporting locations","frepple", "2")
-        logger.error("==== Exporting locations.")
-        for i in self.export_locations():
-            yield i
-        # _log_logging(self.env, "==== Exporting customers","frepple", "3")
-        logger.error("==== Exporting customers.")
-        for i in self.export_customers():
-            yield i
-        if self.mode == 1:
-            # _log_logging(self.env, "==== Exporting suppliers","frepple", "4")
-            logger.error("==== Exporting suppliers.")
-            for i in self.export_suppliers():
-                yield i
-            # _log_logging(self.env, "==== Exporting workcenters","frepple", "5")
-            logger.error("==== Exporting workcenters.")
-            for i in self.export_workcenters():
-                yield i
-        # _log_logging(self.env, "==== Exporting products","frepple", "6")
-        logger.error("==== Exporting products.")
-        for i in self.export_items():
-            yield i
-        # _log_logging(self.env, "==== Exporting BOMs","frepple", "7")
-        logger.error("==== Exporting BOMs.")
-        if self.mode == 1:
-            for i in self.export_boms():
-                yield i
-        # _log_logging(self.env, "==== Exporting transfer","frepple", "8")
-        logger.error("==== Exporting sales orders.")
-
-        # for i in self.export_salesorders():
-        #    yield i
-        logger.error("==== DONE Exporting sales orders.")
-        if self.mode == 1:
-            # _log_logging(self.env, "==== Exporting purchase","frepple", "9")
-            logger.error("==== Exporting purchase orders.")
-            for i in self.export_purchaseorders():
-                yield i
-            # _log_logging(self.env, "==== Exporting manufacturing","frepple", "10")
-            logger.error("==== Exporting manufacturing orders.")
-            for i in self.export_manufacturingorders():
-                yield i
-            # _log_logging(self.env, "==== Exporting quantities","frepple", "12")
-            logger.error("==== Exporting quantities on-hand.")
-            for i in self.export_onhand():
+        sections = [i for i in self.sections if self.mode in i[2]]
+        if shared is None:
+            if self.parallel > 1:
+                for i in self.run_parallel(sections):
+                    yield i
+            else:
+                for section, description, modes, dependencies in sections:
+                    logger.error("==== Exporting %s." % description)
+                    for i in self.instrumented_section(section):
+                        yield i
+        else:
+            for i in self.run_shared(sections, shared):
                 yield i
 
+        # Remember what we sent, for the next incremental export
+        if self.watermarks:
+            self.save_watermarks()
+        if self.uom_conversion_errors:
+            logger.warning(
+                "Can't convert %s combinations of unit of measure and product template, eg %s"
+                % (
+                    len(self.uom_conversion_errors),
+                    ", ".join(
+                        "%s for product template %s" % (self.uom[u]["name"], t)
+                        for u, t in sorted(self.uom_conversion_errors)[:10]
+                    ),
+                )
+            )
+        if self.use_cache:
+            logger.info(
+                "Fragment cache: %s"
+                % ", ".join(
+                    "%s %s hits %s misses %s bytes reused"
+                    % (k, v["hits"], v["misses"], v["bytes"])
+                    for k, v in sorted(fragment_cache_stats.items())
+                )
+            )
+        memo = quoteattr_memo.cache_info()
+        logger.info(
+            "Attribute escaping memo of the process: %s hits, %s misses, %s entries"
+            % (memo.hits, memo.misses, memo.currsize)
+        )
+        yield self.report_stats(sections)
+
         # Footer
         yield "</plan>\n"
 
+    def run_shared(self, sections, shared):
+        """
+        Generates the sections of a document of a multi-company export.
+
+        Sections stored in the shared dictionary are reused, with the records
+        they registered for the watermark bookkeeping. The other sections are
+        generated, and the ones that don't depend on the company are stored.
+
+        The sections are generated one after the other, such that the records
+        registered by each section are known.
+        """
+        for section, description, modes, dependencies in sections:
+            if section in shared:
+                logger.info("==== Reusing %s." % description)
+                fragment, bookkeeping = shared[section]
+                self.delta_current.update(copy.deepcopy(bookkeeping))
+                if self.progress:
+                    self.progress(self.company, section, None)
+                    self.progress(self.company, section, {"reused": True})
+                yield fragment
+                continue
+            logger.error("==== Exporting %s." % description)
+            entities = set(self.delta_current)
+            fragment = "".join(self.instrumented_section(section))
+            if section not in self.company_sections:
+                shared[section] = (
+                    fragment,
+                    {
+                        entity: dict(keys)
+                        for entity, keys in self.delta_current.items()
+                        if entity not in entities
+                    },
+                )
+            yield fragment
+
+    def run_companies(self, companies, chunk_size=None):
+        """
+        Exports several companies in a single pass, reading the data that
+        doesn't depend on the company only once.
+
+        Yields a tuple with the company name and the chunks of its document,
+        as returned by run_chunked. The chunks of a company must be consumed
+        before moving to the next company.
+        """
+        if self.mode == 3:
+            # The sections shared between the companies would only contain the
+            # changes since the previous export of the first company
+            raise ValueError("The incremental export supports a single company")
+        shared = {}
+        for company in companies:
+            self.company = company
+            yield company, self.run_chunked(chunk_size, shared=shared)
+
+    def run_chunked(self, chunk_size=None, shared=None):
+        """
+        Generates the same document as run, but grouped in large strings and
+        converted to the output format.
+        The sections yield many small strings, which are buffered and joined
+        such that the consumer only handles a chunk every chunk_size
+        characters.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        serializer = self.serializer()
+        buffer = []
+        size = 0
+        for i in self.run(shared):
+            buffer.append(i)
+            size += len(i)
+            if size >= chunk_size:
+                data = serializer.feed("".join(buffer))
+                if data:
+                    yield data
+                buffer = []
+                size = 0
+        data = serializer.feed("".join(buffer)) + serializer.close()
+        if data:
+            yield data
+
+    def run_parallel(self, sections):
+        """
+        Generates the sections in a pool of worker threads, and returns their
+        output in the order of the document.
+
+        Each worker uses its own database cursor. All cursors share the snapshot
+        of the main transaction, such that all sections see the same data.
+        A section is only started when the sections it depends on are finished.
+        """
+        self.env.cr.execute("SELECT pg_export_snapshot()")
+        snapshot = self.env.cr.fetchone()[0]
+        lock = threading.Lock()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            # Sections are submitted in document order, and only depend on
+            # sections earlier in the document. A worker waiting for a
+            # dependency therefore never blocks the dependency itself.
+            for section, description, modes, dependencies in sections:
+                futures[section] = pool.submit(
+                    self.run_worker,
+                    section,
+                    description,
+                    [futures[d] for d in dependencies if d in futures],
+                    snapshot,
+                    lock,
+                )
+            for section, description, modes, dependencies in sections:
+                yield futures[section].result()
+
+    def run_worker(self, section, description, dependencies, snapshot, lock):
+        """
+        Generates a single section in a worker thread.
+        The lookup data populated by the section is copied back to this
+        exporter when it is finished.
+        """
+        for d in dependencies:
+            d.result()
+        logger.error("==== Exporting %s." % description)
+        with odoo.api.Environment.manage():
+            with odoo.registry(self.env.cr.dbname).cursor() as cr:
+                cr.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+                with lock:
+                    worker = copy.copy(self)
+                    before = dict(worker.__dict__)
+                worker.env = odoo.api.Environment(
+                    cr, self.env.uid, dict(self.env.context)
+                )
+                worker.generator = Odoo_generator(worker.env, self.pagesize)
+                fragment = "".join(worker.instrumented_section(section))
+                cr.rollback()
+        with lock:
+            for attr, value in worker.__dict__.items():
+                if attr not in ("env", "generator") and before.get(attr) is not value:
+                    setattr(self, attr, value)
+        return fragment
+
+    def instrumented_section(self, section):
+        """
+        Generates a section while measuring the resources it uses:
+          - wall: elapsed seconds spent in the section
+          - cpu: CPU seconds of the thread spent in the section
+          - rows_read: number of records read
+          - rows_emitted: number of lines of XML generated
+          - bytes: number of characters of XML generated
+          - queries: number of SQL queries executed
+          - memory_peak: peak of memory allocated in bytes, when the memory
+            is profiled
+
+        Only the time spent generating the section is counted, not the time
+        the consumer of the output spends between two strings.
+        """
+        stats = {
+            "section": section,
+            "wall": 0.0,
+            "cpu": 0.0,
+            "rows_read": 0,
+            "rows_emitted": 0,
+            "bytes": 0,
+            "queries": 0,
+            "memory_peak": None,
+        }
+        rows = self.generator.rows
+        queries = self.env.cr.sql_log_count
+        # Tracemalloc is process wide: sections generated in parallel can't be
+        # measured separately.
+        trace = (
+            self.profile_memory and self.parallel <= 1 and not tracemalloc.is_tracing()
+        )
+        if trace:
+            tracemalloc.start()
+        if self.progress:
+            self.progress(self.company, section, None)
+        try:
+            iterator = self.cached_section(section)
+            while True:
+                wall = time.perf_counter()
+                cpu = time.thread_time()
+                try:
+                    i = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats["wall"] += time.perf_counter() - wall
+                    stats["cpu"] += time.thread_time() - cpu
+                stats["rows_emitted"] += i.count("\n")
+                stats["bytes"] += len(i)
+                yield i
+        finally:
+            if trace:
+                stats["memory_peak"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            stats["rows_read"] = self.generator.rows - rows
+            stats["queries"] = self.env.cr.sql_log_count - queries
+            self.section_stats.append(stats)
+            if self.progress:
+                self.progress(self.company, section, stats)
+
+    def report_stats(self, sections):
+        """
+        Logs the statistics of the sections, with the company they belong to.
+        They are also kept in the Odoo log table as a history of the export
+        performance.
+        Returns them as an XML comment for the trailer of the document.
+        """
+        order = [i[0] for i in sections]
+        stats = sorted(
+            self.section_stats,
+            key=lambda i: order.index(i["section"]) if i["section"] in order else 0,
+        )
+        summary = {
+            "database": self.env.cr.dbname,
+            "company": self.company,
+            "mode": self.mode,
+            "sections": stats,
+        }
+        logger.info("Export statistics: %s" % json.dumps(summary))
+        # In a transaction of its own, such that a failure doesn't abort the
+        # transaction of the export
+        try:
+            with odoo.api.Environment.manage():
+                with odoo.registry(self.env.cr.dbname).cursor() as cr:
+                    _log_logging(
+                        odoo.api.Environment(cr, self.env.uid, dict(self.env.context)),
+                        json.dumps(summary),
+                        "export statistics",
+                        self.company or "",
+                    )
+        except Exception as e:
+            logger.warning("Can't store the export statistics: %s" % e)
+        lines = [
+            "%-28s %9s %9s %10s %10s %12s %8s %12s"
+            % (
+                "section",
+                "wall",
+                "cpu",
+                "rows read",
+                "rows out",
+                "bytes",
+                "queries",
+                "memory peak",
+            )
+        ]
+        for i in stats:
+            lines.append(
+                "%-28s %9.3f %9.3f %10d %10d %12d %8d %12s"
+                % (
+                    i["section"],
+                    i["wall"],
+                    i["cpu"],
+                    i["rows_read"],
+                    i["rows_emitted"],
+                    i["bytes"],
+                    i["queries"],
+                    "" if i["memory_peak"] is None else i["memory_peak"],
+                )
+            )
+        return "<!-- export statistics\n%s\n-->\n" % "\n".join(lines)
+
     def load_company(self):
         m = self.env["res.company"]
         recs = m.search([("name", "=", self.company)])
@@ -254,33 +1009,435 @@ class exporter(object):
                 "category": i["category_id"][0],
                 "name": i["name"],
             }
+        # Conversion factors per (uom, product template), see convert_qty_uom
+        self.uom_conversion = {}
+        self.uom_conversion_errors = set()
+
+    def load_uom_conversions(self):
+        """
+        Precomputes the conversion factors to the reference unit of measure of
+        each product template, for quantities expressed in that same unit.
+        Other combinations are added on their first use by convert_qty_uom.
+        """
+        for tmpl_id, tmpl in self.product_templates.items():
+            if tmpl["uom_id"]:
+                self.uom_conversion[(tmpl["uom_id"][0], tmpl_id)] = 1.0
+
+    def load_watermarks(self):
+        """
+        Loading the bookkeeping of the previous export for the incremental mode.
+
+        The new watermark is the start of this export, minus a safety margin
+        to catch transactions that started earlier but committed later.
+        Sending a record twice is harmless, missing a change is not.
+        """
+        self.delta_watermarks = {}
+        self.delta_current = {}
+        self.delta_emitted = {}
+        # Changed records of which the element isn't generated yet
+        self.delta_pending = {}
+        self.env.cr.execute("SELECT now() at time zone 'UTC'")
+        self.delta_start = self.env.cr.fetchone()[0] - timedelta(minutes=5)
+        if self.mode != 3 or not self.company_id:
+            return
+        m = self.env["frepple.export.watermark"].sudo()
+        recs = m.search([("company_id", "=", self.company_id)])
+        for i in recs.read(["entity", "watermark", "exported_keys"]):
+            try:
+                keys = json.loads(i["exported_keys"] or "{}")
+            except Exception:
+                logger.warning("Invalid watermark for %s, resending" % i["entity"])
+                continue
+            self.delta_watermarks[i["entity"]] = (i["watermark"], keys)
+
+    def save_watermarks(self):
+        """
+        Storing the watermark and the exported records of each entity.
+        A complete export (mode 1) also registers a watermark, such that
+        an incremental export can follow.
+        """
+        if self.mode not in (1, 3) or not self.company_id:
+            return
+        m = self.env["frepple.export.watermark"].sudo()
+        existing = {
+            i.entity: i for i in m.search([("company_id", "=", self.company_id)])
+        }
+        for entity, keys in self.delta_current.items():
+            vals = {"watermark": self.delta_start, "exported_keys": json.dumps(keys)}
+            if entity in existing:
+                existing[entity].write(vals)
+            else:
+                vals.update({"company_id": self.company_id, "entity": entity})
+                m.create(vals)
+
+    def is_changed(self, entity, key, name, *write_dates, force=False):
+        """
+        Registers a record for the watermark bookkeeping and returns whether it
+        needs to be sent to frePPLe.
+
+        In modes other than 3 every record is sent. In mode 3 only new, renamed
+        or records with a write_date after the previous watermark are sent, as
+        well as the records the caller forces because a dependency changed.
+
+        A record to send is only registered when the caller reports it with
+        the exported method, after its element has been generated. A record
+        that fails to export is thus sent again by the next incremental export.
+        """
+        key = str(key)
+        if self.mode == 3:
+            watermark, keys = self.delta_watermarks.get(entity, (None, {}))
+            if (
+                watermark
+                and not force
+                and keys.get(key) == name
+                and not any(d and d > watermark for d in write_dates)
+            ):
+                self.delta_current.setdefault(entity, {})[key] = name
+                return False
+        self.delta_pending.setdefault(entity, {})[key] = name
+        return True
+
+    def exported(self, entity, key):
+        """
+        Registers a record for which is_changed returned True, once its
+        element has been generated.
+        """
+        key = str(key)
+        name = self.delta_pending[entity].pop(key)
+        self.delta_current.setdefault(entity, {})[key] = name
+        self.delta_emitted.setdefault(entity, set()).add(key)
+
+    def deleted_records(self, entity):
+        """
+        Returns the frePPLe names exported previously for records that no longer
+        exist (or that have been renamed) in Odoo. Only used in mode 3.
+        """
+        if self.mode != 3:
+            return
+        current = self.delta_current.get(entity, {})
+        # Records that failed to export still exist
+        pending = self.delta_pending.get(entity, {})
+        for key, name in self.delta_watermarks.get(entity, (None, {}))[1].items():
+            if key not in pending and current.get(key) != name:
+                yield name
+
+    def snapshot_settings(self):
+        """
+        Returns the user and the settings that determine the document
+        generated from the same data. A snapshot is only served to a request
+        with exactly the same settings.
+        """
+        return {
+            "database": self.database,
+            "uid": self.env.uid,
+            "company": self.company,
+            "mode": self.mode,
+            "format": self.serializer.extension,
+            "lang": self.env.context.get("lang", None),
+            "timezone": self.timezone,
+            "sql_readers": self.sql_readers,
+            "calendar_horizon": self.calendar_horizon,
+            "calendar_start": (
+                self.calendar_start.isoformat() if self.calendar_start else None
+            ),
+        }
+
+    def data_fingerprint(self):
+        """
+        Returns a fingerprint of all data read by the export and of the
+        settings of the exporter. It changes when the export would generate
+        a different document.
+        """
+        tables = set(self.snapshot_tables)
+        for i in self.cacheable_sections.values():
+            tables.update(i[0])
+        return hashlib.sha1(
+            repr(
+                (
+                    self.table_fingerprint(sorted(tables)),
+                    sorted(self.snapshot_settings().items()),
+                )
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def table_fingerprint(self, tables):
+        """
+        Returns a cheap fingerprint of a list of tables: the most recent
+        write_date and the number of records. Tables of modules that aren't
+        installed are ignored.
+        """
+        self.env.cr.execute(
+            "SELECT t FROM unnest(%s) t WHERE to_regclass(t) IS NOT NULL",
+            (list(tables),),
+        )
+        existing = [i[0] for i in self.env.cr.fetchall()]
+        if not existing:
+            return ()
+        self.env.cr.execute(
+            " UNION ALL ".join(
+                "SELECT '%s', max(write_date), count(*) FROM %s" % (t, t)
+                for t in existing
+            )
+        )
+        return tuple(self.env.cr.fetchall())
+
+    def sql_rows(self, query, params=()):
+        """
+        Runs a query and returns its rows as dictionaries, one page at a time.
+        No other query can run on the cursor while the rows are consumed.
+        """
+        self.env.cr.execute(query, params)
+        while True:
+            rows = self.env.cr.dictfetchmany(1000)
+            if not rows:
+                break
+            self.generator.rows += len(rows)
+            for i in rows:
+                yield i
+
+    def sql_search(self, model, domain=()):
+        """
+        Returns a query selecting the ids of the records of a model that a
+        search with the ORM returns, and its parameters. Like the ORM it
+        applies the active filter and the record rules of the connector user,
+        such as the multi-company rules.
+        """
+        m = self.env[model]
+        query = m._where_calc(list(domain))
+        m._apply_ir_rules(query, "read")
+        from_clause, where_clause, params = query.get_sql()
+        return (
+            'SELECT "%s".id FROM %s%s'
+            % (
+                m._table,
+                from_clause,
+                " WHERE %s" % where_clause if where_clause else "",
+            ),
+            list(params),
+        )
+
+    def sql_product_templates(self):
+        """
+        Fast alternative for reading the product.template records with the ORM.
+        Only the fields used by the connector are returned.
+
+        Like all sql_* readers it returns the same records in the same order
+        as the ORM reader it replaces: see sql_search.
+        """
+        templates, templates_params = self.sql_search(
+            "product.template", [("type", "!=", "service"), ("list_price", ">=", 0)]
+        )
+        variants, variants_params = self.sql_search("product.product")
+        for i in self.sql_rows(
+            "SELECT pt.id, pt.purchase_ok, pt.produce_delay, pt.list_price, "
+            "pt.uom_id, uom_uom.name AS uom_name, "
+            "pt.categ_id, product_category.complete_name AS categ_name, "
+            "pt.write_date, "
+            "array("
+            "  SELECT pp.id FROM product_product pp "
+            "  WHERE pp.product_tmpl_id = pt.id AND pp.id IN (" + variants + ") "
+            "  ORDER BY pp.default_code, pp.id"
+            "  ) AS product_variant_ids "
+            "FROM product_template pt "
+            "INNER JOIN uom_uom ON uom_uom.id = pt.uom_id "
+            "LEFT OUTER JOIN product_category ON product_category.id = pt.categ_id "
+            "WHERE pt.id IN (" + templates + ") "
+            "ORDER BY pt.id",
+            variants_params + templates_params,
+        ):
+            yield {
+                "id": i["id"],
+                "purchase_ok": i["purchase_ok"],
+                "produce_delay": i["produce_delay"],
+                "list_price": i["list_price"],
+                "uom_id": [i["uom_id"], i["uom_name"]],
+                "categ_id": (
+                    [i["categ_id"], i["categ_name"]] if i["categ_id"] else False
+                ),
+                "product_variant_ids": i["product_variant_ids"],
+                "write_date": i["write_date"],
+            }
+
+    def sql_products(self):
+        """
+        Fast alternative for reading the product.product records with the ORM.
+        The product name is translated in the language of the connector user,
+        the way the ORM does it.
+        """
+        lang = self.env.context.get("lang", None)
+        products, params = self.sql_search("product.product", [("lst_price", ">=", 0)])
+        for i in self.sql_rows(
+            "SELECT pp.id, pp.default_code, pp.product_tmpl_id, pp.write_date, "
+            "COALESCE(ir_translation.value, pt.name) AS name, "
+            "array("
+            "  SELECT rel.product_attribute_value_id "
+            "  FROM product_attribute_value_product_product_rel rel "
+            "  WHERE rel.product_product_id = pp.id"
+            "  ) AS attribute_value_ids "
+            "FROM product_product pp "
+            "INNER JOIN product_template pt ON pt.id = pp.product_tmpl_id "
+            "LEFT OUTER JOIN ir_translation "
+            "  ON ir_translation.res_id = pt.id "
+            "  AND ir_translation.type = 'model' "
+            "  AND ir_translation.name = 'product.template,name' "
+            "  AND ir_translation.lang = %s "
+            "  AND ir_translation.value != '' "
+            "WHERE pp.id IN (" + products + ") "
+            "ORDER BY pp.id",
+            [lang if lang and lang != "en_US" else None] + params,
+        ):
+            yield {
+                "id": i["id"],
+                "name": i["name"],
+                "code": i["default_code"],
+                "product_tmpl_id": [i["product_tmpl_id"], None],
+                "attribute_value_ids": i["attribute_value_ids"],
+                "write_date": i["write_date"],
+            }
+
+    def sql_supplierinfo(self):
+        """
+        Fast alternative for reading the product.supplierinfo records with the ORM.
+        The supplier is returned with its display name, as name_get does.
+        """
+        supplierinfo, params = self.sql_search("product.supplierinfo")
+        for i in self.sql_rows(
+            "SELECT si.product_tmpl_id, si.name AS partner_id, "
+            "res_partner.display_name AS partner_name, si.delay, si.min_qty, "
+            "si.date_end, si.date_start, si.price, si.write_date "
+            "FROM product_supplierinfo si "
+            "INNER JOIN res_partner ON res_partner.id = si.name "
+            "WHERE si.id IN (" + supplierinfo + ") "
+            "ORDER BY si.sequence, si.min_qty DESC, si.price, si.id",
+            params,
+        ):
+            yield {
+                "product_tmpl_id": (
+                    [i["product_tmpl_id"], None] if i["product_tmpl_id"] else False
+                ),
+                "name": [i["partner_id"], i["partner_name"]],
+                "delay": i["delay"],
+                "min_qty": i["min_qty"],
+                "date_end": i["date_end"],
+                "date_start": i["date_start"],
+                "price": i["price"],
+                "write_date": i["write_date"],
+            }
+
+    def sql_partners(self, flag):
+        """
+        Fast alternative for reading the active customers or suppliers with the ORM.
+        """
+        if flag not in ("customer", "supplier"):
+            raise ValueError("Invalid partner flag %s" % flag)
+        partners, params = self.sql_search("res.partner", [(flag, "=", True)])
+        return self.sql_rows(
+            "SELECT id, name, write_date FROM res_partner "
+            "WHERE id IN (" + partners + ") "
+            "ORDER BY id",
+            params,
+        )
+
+    def cached_section(self, section):
+        """
+        Generates a section, or splices it from the fragment cache when none of
+        its source tables has changed since it was cached.
+
+        The incremental export (mode 3) bypasses the cache, since its output
+        depends on the previous export. A section served from the cache still
+        registers its records, such that the watermarks saved by a complete
+        export cover them.
+
+        The cache keeps its own copy of the attributes of a section, since
+        later sections and exports may modify them.
+        """
+        if (
+            not self.use_cache
+            or self.mode == 3
+            or section not in self.cacheable_sections
+        ):
+            for i in getattr(self, section)():
+                yield i
+            return
+        tables, attributes, settings, entities = self.cacheable_sections[section]
+        fingerprint = (
+            self.table_fingerprint(tables),
+            tuple(getattr(self, s, None) for s in settings),
+        )
+        key = (
+            self.env.cr.dbname,
+            self.env.uid,
+            self.env.context.get("lang", None),
+            self.company_id,
+            section,
+        )
+        with fragment_cache_lock:
+            stats = fragment_cache_stats.setdefault(
+                section, {"hits": 0, "misses": 0, "bytes": 0}
+            )
+            cached = fragment_cache.get(key, None)
+            if cached and cached[0] == fingerprint:
+                stats["hits"] += 1
+                stats["bytes"] += len(cached[1])
+            else:
+                stats["misses"] += 1
+                cached = None
+        if cached:
+            for attr, value in copy.deepcopy(cached[2]).items():
+                setattr(self, attr, value)
+            for entity, keys in cached[3].items():
+                self.delta_current.setdefault(entity, {}).update(keys)
+                self.delta_emitted.setdefault(entity, set()).update(keys)
+            yield cached[1]
+            return
+        fragment = []
+        for i in getattr(self, section)():
+            fragment.append(i)
+            yield i
+        with fragment_cache_lock:
+            fragment_cache[key] = (
+                fingerprint,
+                "".join(fragment),
+                copy.deepcopy({attr: getattr(self, attr) for attr in attributes}),
+                {
+                    entity: dict(self.delta_current.get(entity, {}))
+                    for entity in entities
+                },
+            )
 
     def convert_qty_uom(self, qty, uom_id, product_template_id=None):
         """
         Convert a quantity to the reference uom of the product template.
         """
-
         if not uom_id:
             return qty
-        if not product_template_id:
-            return qty * self.uom[uom_id]["factor"]
+        try:
+            return qty * self.uom_conversion[(uom_id, product_template_id)]
+        except KeyError:
+            return qty * self.uom_factor(uom_id, product_template_id)
+
+    def uom_factor(self, uom_id, product_template_id):
+        """
+        Computes the factor converting a quantity in a uom to the reference uom
+        of the product template, and stores it in the conversion table.
+        """
+        factor = self.uom[uom_id]["factor"]
         try:
             product_uom = self.product_templates[product_template_id]["uom_id"][0]
         except Exception:
-            return qty * self.uom[uom_id]["factor"]
-        # check if default product uom is the one we received
+            product_uom = None
         if product_uom == uom_id:
-            return qty
-        # check if different uoms belong to the same category
-        if self.uom[product_uom]["category"] == self.uom[uom_id]["category"]:
-            return qty * self.uom[uom_id]["factor"] / self.uom[product_uom]["factor"]
-        else:
-            # UOM is from a different category as the reference uom of the product.
-            logger.warning(
-                "Can't convert from %s for product template %s"
-                % (self.uom[uom_id]["name"], product_template_id)
-            )
-            return qty * self.uom[uom_id]["factor"]
+            factor = 1.0
+        elif product_uom:
+            # check if different uoms belong to the same category
+            if self.uom[product_uom]["category"] == self.uom[uom_id]["category"]:
+                factor /= self.uom[product_uom]["factor"]
+            else:
+                # UOM is from a different category as the reference uom of the
+                # product. Reported once at the end of the export.
+                self.uom_conversion_errors.add((uom_id, product_template_id))
+        self.uom_conversion[(uom_id, product_template_id)] = factor
+        return factor
 
     def convert_float_time(self, float_time):
         """
@@ -294,10 +1451,41 @@ class exporter(object):
             int(d.seconds % 60),  # duration: seconds
         )
 
+    def get_timezone(self, tmzone=None):
+        """
+        Returns the pytz timezone object with a given name, which is only
+        built once per export.
+        """
+        return self.dates.get_timezone(tmzone)
+
     def formatDateTime(self, d, tmzone=None):
-        if not isinstance(d, datetime):
-            d = datetime.fromisoformat(d)
-        return d.astimezone(timezone(tmzone or self.timezone)).strftime(self.timeformat)
+        return self.dates.format(d, tmzone)
+
+    def calendar_weeks(self, start, end, week_type, tmzone):
+        """
+        Returns the formatted start and end of the weeks between two dates
+        of which the iso week number has the parity of the week type.
+
+        When a calendar horizon is set, only the weeks within the horizon
+        are returned.
+        """
+        if self.calendar_horizon:
+            if start < self.calendar_start:
+                start = self.calendar_start
+            end = min(end, self.calendar_start + timedelta(days=self.calendar_horizon))
+        weeks = []
+        t = start
+        while t < end:
+            next_week = t + timedelta(7 - t.weekday())
+            if t.isocalendar()[1] % 2 == int(week_type):
+                weeks.append(
+                    (
+                        self.formatDateTime(t, tmzone),
+                        self.formatDateTime(min(next_week, end), tmzone),
+                    )
+                )
+            t = next_week
+        return weeks
 
     def export_calendar(self):
         """
@@ -327,6 +1515,8 @@ class exporter(object):
         calendars = {}
         cal_tz = {}
         cal_ids = set()
+        # Weeks of the two-week calendars, computed once per date range
+        cal_weeks = {}
         try:
             # Read the timezone
             for i in self.generator.getData(
@@ -339,18 +1529,31 @@ class exporter(object):
                 cal_tz[i["name"]] = i["tz"]
                 cal_ids.add(i["id"])
 
-            # Read the attendance for all calendars
-            for i in self.generator.getData(
-                "resource.calendar.attendance",
-                fields=[
-                    "dayofweek",
-                    "date_from",
-                    "date_to",
-                    "hour_from",
-                    "hour_to",
-                    "calendar_id",
-                ],
+            # Read the attendance for all calendars.
+            # Two-week calendars only exist from Odoo 13 on, which also adds
+            # section lines to group the attendances of each week.
+            attendance_fields = [
+                "dayofweek",
+                "date_from",
+                "date_to",
+                "hour_from",
+                "hour_to",
+                "calendar_id",
+            ]
+            for f in ("week_type", "display_type"):
+                if f in self.env["resource.calendar.attendance"]._fields:
+                    attendance_fields.append(f)
+            # Read by id, but the priorities of the buckets follow the order
+            # of the model: by day of the week and start hour
+            for i in sorted(
+                self.generator.getData(
+                    "resource.calendar.attendance",
+                    fields=attendance_fields,
+                ),
+                key=lambda i: (i["dayofweek"] or "", i["hour_from"] or 0),
             ):
+                if i.get("display_type", False):
+                    continue
                 if i["calendar_id"] and i["calendar_id"][0] in cal_ids:
                     if i["calendar_id"][1] not in calendars:
                         calendars[i["calendar_id"][1]] = []
@@ -430,42 +1633,48 @@ class exporter(object):
                             priority_leave += 1
                     else:
                         # TWO-WEEKS CALENDAR
-                        start = j["date_from"] or datetime(2020, 1, 1)
-                        end = j["date_to"] or datetime(2030, 1, 1)
-
-                        t = start
-                        while t < end:
-                            if int(t.isocalendar()[1] % 2) == int(j["week_type"]):
-                                if j["hour_to"] == 0:
-                                    logger.info(j)
-                                yield '<bucket start="%s" end="%s" value="%s" days="%s" priority="%s" starttime="%s" endtime="%s"/>\n' % (
-                                    self.formatDateTime(t, cal_tz[i]),
-                                    self.formatDateTime(
-                                        min(t + timedelta(7 - t.weekday()), end),
-                                        cal_tz[i],
-                                    ),
-                                    "1",
-                                    (
-                                        (2 ** ((int(j["dayofweek"]) + 1) % 7))
-                                        if "dayofweek" in j
-                                        else (2**7) - 1
-                                    ),
-                                    priority_attendance,
-                                    # In odoo, monday = 0. In frePPLe, sunday = 0.
-                                    (
-                                        ("PT%dM" % round(j["hour_from"] * 60))
-                                        if "hour_from" in j
-                                        else "PT0M"
-                                    ),
-                                    (
-                                        ("PT%dM" % round(j["hour_to"] * 60))
-                                        if "hour_to" in j
-                                        else "PT1440M"
-                                    ),
-                                )
-                                priority_attendance += 1
-                            dow = t.weekday()
-                            t += timedelta(7 - dow)
+                        start = (
+                            datetime.combine(j["date_from"], datetime.min.time())
+                            if j["date_from"]
+                            else datetime(2020, 1, 1)
+                        )
+                        end = (
+                            datetime.combine(j["date_to"], datetime.min.time())
+                            if j["date_to"]
+                            else datetime(2030, 1, 1)
+                        )
+                        key = (start, end, int(j["week_type"]), cal_tz[i])
+                        weeks = cal_weeks.get(key, None)
+                        if weeks is None:
+                            weeks = cal_weeks[key] = self.calendar_weeks(*key)
+                        if weeks and j["hour_to"] == 0:
+                            logger.info(j)
+
+                        # Everything except the dates is identical for all weeks
+                        bucket = (
+                            '<bucket start="%%s" end="%%s" value="1" days="%s" priority="%%s" starttime="%s" endtime="%s"/>\n'
+                            % (
+                                (
+                                    (2 ** ((int(j["dayofweek"]) + 1) % 7))
+                                    if "dayofweek" in j
+                                    else (2**7) - 1
+                                ),
+                                # In odoo, monday = 0. In frePPLe, sunday = 0.
+                                (
+                                    ("PT%dM" % round(j["hour_from"] * 60))
+                                    if "hour_from" in j
+                                    else "PT0M"
+                                ),
+                                (
+                                    ("PT%dM" % round(j["hour_to"] * 60))
+                                    if "hour_to" in j
+                                    else "PT1440M"
+                                ),
+                            )
+                        )
+                        for week_start, week_end in weeks:
+                            yield bucket % (week_start, week_end, priority_attendance)
+                            priority_attendance += 1
 
                 yield "</buckets></calendar>\n"
 
@@ -495,22 +1704,22 @@ class exporter(object):
         """
         self.map_locations = {}
         self.warehouses = set()
+        self.warehouse_views = []
         childlocs = {}
-        m = self.env["stock.warehouse"]
-        recs = m.search([])
+        fields = [
+            "name",
+            "lot_stock_id",
+            "wh_input_stock_loc_id",
+            "wh_output_stock_loc_id",
+            "wh_pack_stock_loc_id",
+            "wh_qc_stock_loc_id",
+            "view_location_id",
+        ]
+        recs = peek(self.generator.getData("stock.warehouse", fields=fields))
         if recs:
             yield "<!-- warehouses -->\n"
             yield "<locations>\n"
-            fields = [
-                "name",
-                "lot_stock_id",
-                "wh_input_stock_loc_id",
-                "wh_output_stock_loc_id",
-                "wh_pack_stock_loc_id",
-                "wh_qc_stock_loc_id",
-                "view_location_id",
-            ]
-            for i in recs.read(fields):
+            for i in recs:
                 yield '<location name=%s subcategory="%s"><available name=%s/></location>\n' % (
                     quoteattr(i["name"]),
                     i["id"],
@@ -526,33 +1735,39 @@ class exporter(object):
                 childlocs[i["id"]] = i["name"]
 
                 self.warehouses.add(i["name"])
+                self.warehouse_views.append(i["view_location_id"][0])
             yield "</locations>\n"
 
             # Populate a mapping location-to-warehouse name for later lookups
-            parent_loc = {}
-            m = self.env["stock.location"]
-            recs = m.search([])
-            for i in recs.read(["location_id"]):
-                if i["location_id"]:
-                    parent_loc[i["id"]] = i["location_id"][0]
-
-            marked = {}
-
-            def fnd_parent(loc_id):  # go up the parent chain to find the warehouse
-                if not marked.get(loc_id):  # ensures O(N) iterations instead of O(N^2)
-                    if childlocs.get(loc_id):
-                        return childlocs[loc_id]
-                    if parent_loc.get(loc_id):
-                        parent = fnd_parent(parent_loc[loc_id])
-                        if parent:
-                            return parent
-                marked[loc_id] = True
-                return -1
-
-            for loc_id in recs:
-                parent = fnd_parent(loc_id["id"])
-                if parent:
-                    self.map_locations[loc_id["id"]] = parent
+            self.map_locations = self.location_warehouses(childlocs)
+
+    def location_warehouses(self, childlocs):
+        """
+        Maps every location to the warehouse of its nearest ancestor (or
+        itself) that is one of the warehouse locations. Locations outside
+        all warehouses are mapped to -1.
+
+        The ancestors are read from the parent_path of the locations, so the
+        mapping is built in a single pass without walking the parent chain.
+        It is cached until a location or a warehouse changes.
+        """
+        fingerprint = self.table_fingerprint(("stock_location", "stock_warehouse"))
+        key = (self.env.cr.dbname, self.env.uid, self.company_id)
+        with location_cache_lock:
+            cached = location_cache.get(key, None)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        map_locations = {}
+        for i in self.generator.getData("stock.location", fields=["parent_path"]):
+            warehouse = -1
+            for loc_id in reversed((i["parent_path"] or str(i["id"])).split("/")):
+                if loc_id and int(loc_id) in childlocs:
+                    warehouse = childlocs[int(loc_id)]
+                    break
+            map_locations[i["id"]] = warehouse
+        with location_cache_lock:
+            location_cache[key] = (fingerprint, map_locations)
+        return map_locations
 
     def export_customers(self):
         """
@@ -563,16 +1778,27 @@ class exporter(object):
         res.partner.id res.partner.name -> customer.name
         """
         self.map_customers = {}
-        m = self.env["res.partner"]
-        recs = m.search([("customer", "=", True)])
+        if self.sql_readers:
+            recs = peek(self.sql_partners("customer"))
+        else:
+            recs = peek(
+                self.generator.getData(
+                    "res.partner",
+                    search=[("customer", "=", True)],
+                    fields=["name", "write_date"],
+                )
+            )
         if recs:
             yield "<!-- customers -->\n"
             yield "<customers>\n"
-            fields = ["name"]
-            for i in recs.read(fields):
+            for i in recs:
                 name = "%d %s" % (i["id"], i["name"])
-                yield "<customer name=%s/>\n" % quoteattr(name)
+                if self.is_changed("customer", i["id"], name, i["write_date"]):
+                    yield "<customer name=%s/>\n" % quoteattr(name)
+                    self.exported("customer", i["id"])
                 self.map_customers[i["id"]] = name
+            for name in self.deleted_records("customer"):
+                yield '<customer name=%s action="R"/>\n' % quoteattr(name)
             yield "</customers>\n"
 
     def export_suppliers(self):
@@ -583,16 +1809,26 @@ class exporter(object):
         Mapping:
         res.partner.id res.partner.name -> supplier.name
         """
-        m = self.env["res.partner"]
-        recs = m.search([("supplier", "=", True)])
+        if self.sql_readers:
+            recs = peek(self.sql_partners("supplier"))
+        else:
+            recs = peek(
+                self.generator.getData(
+                    "res.partner",
+                    search=[("supplier", "=", True)],
+                    fields=["name", "write_date"],
+                )
+            )
         if recs:
             yield "<!-- suppliers -->\n"
             yield "<suppliers>\n"
-            fields = ["name"]
-            for i in recs.read(fields):
-                yield "<supplier name=%s/>\n" % quoteattr(
-                    "%d %s" % (i["id"], i["name"])
-                )
+            for i in recs:
+                name = "%d %s" % (i["id"], i["name"])
+                if self.is_changed("supplier", i["id"], name, i["write_date"]):
+                    yield "<supplier name=%s/>\n" % quoteattr(name)
+                    self.exported("supplier", i["id"])
+            for name in self.deleted_records("supplier"):
+                yield '<supplier name=%s action="R"/>\n' % quoteattr(name)
             yield "</suppliers>\n"
 
     def export_workcenters(self):
@@ -608,15 +1844,16 @@ class exporter(object):
         company.mfg_location -> resource.location
         """
         self.map_workcenters = {}
-        m = self.env["mrp.workcenter"]
-        recs = m.search([])
-        fields = ["name", "capacity", "resource_calendar_id"]
+        fields = ["name", "capacity", "resource_calendar_id", "write_date"]
+        recs = peek(self.generator.getData("mrp.workcenter", fields=fields))
         if recs:
             yield "<!-- workcenters -->\n"
             yield "<resources>\n"
-            for i in recs.read(fields):
+            for i in recs:
                 name = i["name"]
                 self.map_workcenters[i["id"]] = name
+                if not self.is_changed("resource", i["id"], name, i["write_date"]):
+                    continue
                 yield '<resource name=%s maximum="%s">%s<location name=%s/></resource>\n' % (
                     quoteattr(name),
                     i["capacity"],
@@ -627,6 +1864,9 @@ class exporter(object):
                     ),
                     quoteattr(self.mfg_location),
                 )
+                self.exported("resource", i["id"])
+            for name in self.deleted_records("resource"):
+                yield '<resource name=%s action="R"/>\n' % quoteattr(name)
             yield "</resources>\n"
 
     def export_items(self):
@@ -656,13 +1896,11 @@ class exporter(object):
         self.product_template_product = {}
         self.category_parent = {}
 
-        m = self.env["product.category"]
-        fields = ["name", "parent_id"]
-        recs = m.search([])
-        for i in recs.read(fields):
+        for i in self.generator.getData(
+            "product.category", fields=["name", "parent_id"]
+        ):
             if i["parent_id"]:
-                self.category_parent[i["name"]] = i["parent_id"]
-        m = self.env["product.template"]
+                self.category_parent[i["name"]] = i["parent_id"][1]
         fields = [
             "purchase_ok",
             "route_ids",
@@ -674,48 +1912,50 @@ class exporter(object):
             "standard_price",
             "categ_id",
             "product_variant_ids",
+            "write_date",
         ]
         # recs = m.search([("type", "!=", "service")])
         self.product_templates = {}
-        offset = 0
-        pagesize = 1000
-        while True:
-            # recs = m.search([("type", "!=", "service")], limit=pagesize, offset=offset)
-            recs = m.search(
-                [("type", "!=", "service"), ("list_price", ">=", 0)],
-                limit=pagesize,
-                offset=offset,
-            )
-            if not recs:
-                break
-            for i in recs.read(fields):
+        if self.sql_readers:
+            for i in self.sql_product_templates():
+                self.product_templates[i["id"]] = i
+        else:
+            for i in self.generator.getData(
+                "product.template",
+                search=[("type", "!=", "service"), ("list_price", ">=", 0)],
+                fields=fields,
+            ):
                 self.product_templates[i["id"]] = i
-            offset += pagesize
+        self.load_uom_conversions()
 
         # Read the stock location routes
-        rts = self.env["stock.location.route"]
-        fields = ["name"]
-        recs = rts.search([])
         stock_location_routes = {}
-        for i in recs.read(fields):
+        for i in self.generator.getData("stock.location.route", fields=["name"]):
             stock_location_routes[i["id"]] = i
 
-        # Read the products
-        m = self.env["product.product"]
-        recs = m.search([("lst_price", ">=", 0)])
-        s = self.env["product.supplierinfo"]
-        s_fields = [
-            "product_tmpl_id",
-            "name",
-            "delay",
-            "min_qty",
-            "date_end",
-            "date_start",
-            "price",
-        ]
-        s_recs = s.search([])
+        # Read the suppliers
+        if self.sql_readers:
+            suppliers = self.sql_supplierinfo()
+        else:
+            s_fields = [
+                "product_tmpl_id",
+                "name",
+                "delay",
+                "min_qty",
+                "date_end",
+                "date_start",
+                "price",
+                "write_date",
+            ]
+            suppliers = self.generator.getData(
+                "product.supplierinfo",
+                order="sequence, min_qty desc, price, id",
+                fields=s_fields,
+            )
         self.product_supplier = {}
-        for s in s_recs.read(s_fields):
+        # Most recent supplier change per template, for the incremental export
+        supplier_write_date = {}
+        for s in suppliers:
             # logger.error(
             #             "checking product cost %s ============" % (str(s["product_tmpl_id"]))
             #         )
@@ -723,6 +1963,9 @@ class exporter(object):
                 s["product_tmpl_id"] and not s["product_tmpl_id"][0]
             ):
                 continue
+            d = supplier_write_date.get(s["product_tmpl_id"][0], None)
+            if not d or (s["write_date"] and s["write_date"] > d):
+                supplier_write_date[s["product_tmpl_id"][0]] = s["write_date"]
             if s["product_tmpl_id"][0] in self.product_supplier:
                 self.product_supplier[s["product_tmpl_id"][0]].append(
                     (
@@ -745,9 +1988,11 @@ class exporter(object):
                         s["price"],
                     )
                 ]
-        if recs:
-            yield "<!-- products -->\n"
-            yield "<items>\n"
+
+        # Read the products, once all suppliers are processed
+        if self.sql_readers:
+            products = peek(self.sql_products())
+        else:
             fields = [
                 "id",
                 "name",
@@ -755,8 +2000,17 @@ class exporter(object):
                 "product_tmpl_id",
                 "seller_ids",
                 "attribute_value_ids",
+                "write_date",
             ]
-            for i in recs.read(fields):
+            products = peek(
+                self.generator.getData(
+                    "product.product", search=[("lst_price", ">=", 0)], fields=fields
+                )
+            )
+        if products:
+            yield "<!-- products -->\n"
+            yield "<items>\n"
+            for i in products:
                 yielded_header = False
                 try:
                     tmpl = self.product_templates.get(i["product_tmpl_id"][0], None)
@@ -773,6 +2027,15 @@ class exporter(object):
                     }
                     self.product_product[i["id"]] = prod_obj
                     self.product_template_product[i["product_tmpl_id"][0]] = prod_obj
+                    if not self.is_changed(
+                        "item",
+                        i["id"],
+                        name,
+                        i["write_date"],
+                        tmpl["write_date"],
+                        supplier_write_date.get(i["product_tmpl_id"][0], None),
+                    ):
+                        continue
                     yield '<item name=%s cost="%f" category=%s subcategory="%s,%s">\n' % (
                         quoteattr(name),
                         (tmpl["list_price"] or 0)
@@ -783,7 +2046,7 @@ class exporter(object):
                             "%s%s"
                             % (
                                 (
-                                    ("%s/" % self.category_parent(tmpl["categ_id"][1]))
+                                    ("%s/" % self.category_parent[tmpl["categ_id"][1]])
                                     if tmpl["categ_id"][1] in self.category_parent
                                     else ""
                                 ),
@@ -828,12 +2091,15 @@ class exporter(object):
                                 )
                         yield "</itemsuppliers>\n"
                     yield "</item>\n"
+                    self.exported("item", i["id"])
                 except Exception as e:
                     logger.error(
                         "Error ==== Exporting product %s: %s" % (i.get("id", None), e)
                     )
                     if yielded_header:
                         yield "</item>\n"
+            for name in self.deleted_records("item"):
+                yield '<item name=%s action="R"/>\n' % quoteattr(name)
             yield "</items>\n"
 
     def export_boms(self):
@@ -845,31 +2111,40 @@ class exporter(object):
         """
         yield "<!-- bills of material -->\n"
         yield "<operations>\n"
-        self.operations = set()
-
-        # dictionary used to divide the confirmed MO quantities
-        # key is tuple (operation name, produced item)
-        # value is quantity in Operation Materials.
-        self.bom_producedQty = {}
+        # The produced quantity of the operations is used to divide the
+        # confirmed MO quantities
+        self.operation_registry = OperationRegistry()
 
         # Read all active manufacturing routings
-        m = self.env["mrp.routing"]
-        recs = m.search([])
-        fields = ["location_id"]
         mrp_routings = {}
-        for i in recs.read(fields):
+        # Most recent change of a routing or its steps, for the incremental export
+        routing_write_date = {}
+        for i in self.generator.getData(
+            "mrp.routing", fields=["location_id", "write_date"]
+        ):
             mrp_routings[i["id"]] = (
                 self.map_locations.get(i["location_id"][0], None)
                 if i["location_id"]
                 else None
             )
+            routing_write_date[i["id"]] = i["write_date"]
 
         # Read all workcenters of all routings
         mrp_routing_workcenters = {}
-        m = self.env["mrp.routing.workcenter"]
-        recs = m.search([], order="routing_id, sequence asc")
-        fields = ["name", "routing_id", "workcenter_id", "sequence", "time_cycle"]
-        for i in recs.read(fields):
+        fields = [
+            "name",
+            "routing_id",
+            "workcenter_id",
+            "sequence",
+            "time_cycle",
+            "write_date",
+        ]
+        for i in self.generator.getData(
+            "mrp.routing.workcenter", order="routing_id, sequence asc", fields=fields
+        ):
+            d = routing_write_date.get(i["routing_id"][0], None)
+            if not d or (i["write_date"] and i["write_date"] > d):
+                routing_write_date[i["routing_id"][0]] = i["write_date"]
             if i["routing_id"][0] in mrp_routing_workcenters:
                 # If the same workcenter is used multiple times in a routing,
                 # we add the times together.
@@ -894,39 +2169,51 @@ class exporter(object):
                     [i["workcenter_id"][1], i["time_cycle"], i["sequence"], i["name"]]
                 ]
 
-        # Models used in the bom-loop below
-        bom_lines_model = self.env["mrp.bom.line"]
+        # Read all bom lines and byproducts in a single pass, indexed by bom.
+        # The attribute values of a bom line are stored as a set, such that
+        # checking whether the line applies to a variant is a subset test.
+        bom_lines = {}
         bom_lines_fields = [
+            "bom_id",
             "product_qty",
             "product_uom_id",
             "product_id",
             "routing_id",
             "attribute_value_ids",
         ]
-        try:
-            subproduct_model = self.env["mrp.subproduct"]
+        for j in self.generator.getData("mrp.bom.line", fields=bom_lines_fields):
+            j["attribute_value_ids"] = frozenset(j["attribute_value_ids"])
+            bom_lines.setdefault(j["bom_id"][0], []).append(j)
+        subproducts = {}
+        if "mrp.subproduct" in self.env:
             subproduct_fields = [
+                "bom_id",
                 "product_id",
                 "product_qty",
                 "product_uom",
                 "subproduct_type",
             ]
-        except Exception:
-            subproduct_model = None
+            for j in self.generator.getData("mrp.subproduct", fields=subproduct_fields):
+                subproducts.setdefault(j["bom_id"][0], []).append(j)
+
+        # Attribute values of the product variants, as a set
+        variant_attributes = {}
 
         # Loop over all bom records
-        bom_recs = self.env["mrp.bom"].search([])
         bom_fields = [
             "product_qty",
             "product_uom_id",
             "product_tmpl_id",
             "routing_id",
             "type",
-            "bom_line_ids",
-            "sub_products",
             "sequence",
+            "write_date",
         ]
-        for i in bom_recs.read(bom_fields):
+        # The efficiency of the produced quantity, a field only some versions
+        # and customizations of Odoo have
+        if "product_efficiency" in self.env["mrp.bom"]._fields:
+            bom_fields.append("product_efficiency")
+        for i in self.generator.getData("mrp.bom", fields=bom_fields):
             # Determine the location
             if i["routing_id"]:
                 location = mrp_routings.get(i["routing_id"][0], None)
@@ -939,6 +2226,9 @@ class exporter(object):
             if not product_template:
                 continue
 
+            lines = bom_lines.get(i["id"], [])
+            byproducts = subproducts.get(i["id"], [])
+
             for product_id in product_template["product_variant_ids"]:
                 # Determine operation name and item
                 product_buf = self.product_product.get(product_id, None)
@@ -947,19 +2237,62 @@ class exporter(object):
                         "skipping %s %s" % (i["product_tmpl_id"][0], i["routing_id"])
                     )
                     continue
+                variant_values = variant_attributes.get(product_id, None)
+                if variant_values is None:
+                    variant_values = frozenset(product_buf["attribute_value_ids"])
+                    variant_attributes[product_id] = variant_values
                 uom_factor = self.convert_qty_uom(
                     1.0, i["product_uom_id"][0], i["product_tmpl_id"][0]
                 )
-                operation = "%d %s @ %s" % (i["id"], product_buf["name"], location)
-                self.operations.add(operation)
-
-                # Build operation. The operation can either be a summary operation or a detailed
-                # routing.
-                if (
+                registered = self.operation_registry.add(
+                    i["id"], product_id, product_buf["name"], location
+                )
+                operation = registered["name"]
+                single_operation = (
                     not self.manage_work_orders
                     or not i["routing_id"]
                     or not mrp_routing_workcenters.get(i["routing_id"][0], [])
+                )
+
+                # In the incremental mode an unchanged operation isn't sent, unless
+                # its item or one of its components has been sent again.
+                emitted_items = self.delta_emitted.get("item", set())
+                operation_key = "%s,%s" % (i["id"], product_id)
+                if not self.is_changed(
+                    "operation",
+                    operation_key,
+                    operation,
+                    i["write_date"],
+                    routing_write_date.get(i["routing_id"][0], None)
+                    if i["routing_id"]
+                    else None,
+                    force=str(product_id) in emitted_items
+                    or any(str(j["product_id"][0]) in emitted_items for j in lines),
                 ):
+                    # Later sections still need the produced quantity and steps
+                    if single_operation:
+                        registered["produced_qty"] = self.convert_qty_uom(
+                            i["product_qty"],
+                            i["product_uom_id"][0],
+                            i["product_tmpl_id"][0],
+                        )
+                    else:
+                        for counter, step in enumerate(
+                            mrp_routing_workcenters[i["routing_id"][0]], start=1
+                        ):
+                            self.operation_registry.add_step(
+                                registered, step[3], counter * 100
+                            )
+                        registered["produced_qty"] = (
+                            i["product_qty"]
+                            * i.get("product_efficiency", 1.0)
+                            * uom_factor
+                        )
+                    continue
+
+                # Build operation. The operation can either be a summary operation or a detailed
+                # routing.
+                if single_operation:
                     #
                     # CASE 1: A single operation used for the BOM
                     # All routing steps are collapsed in a single operation.
@@ -985,22 +2318,18 @@ class exporter(object):
                         convertedQty,
                         quoteattr(product_buf["name"]),
                     )
-                    self.bom_producedQty[(operation, product_buf["name"])] = (
-                        convertedQty
-                    )
+                    registered["produced_qty"] = convertedQty
 
                     # Build consuming flows.
                     # If the same component is consumed multiple times in the same BOM
                     # we sum up all quantities in a single flow. We assume all of them
                     # have the same effectivity.
                     fl = {}
-                    for j in bom_lines_model.browse(i["bom_line_ids"]).read(
-                        bom_lines_fields
-                    ):
+                    for j in lines:
                         # check if this BOM line applies to this variant
-                        if len(j["attribute_value_ids"]) > 0 and not all(
-                            elem in product_buf["attribute_value_ids"]
-                            for elem in j["attribute_value_ids"]
+                        if (
+                            j["attribute_value_ids"]
+                            and not j["attribute_value_ids"] <= variant_values
                         ):
                             continue
                         product = self.product_product.get(j["product_id"][0], None)
@@ -1026,26 +2355,23 @@ class exporter(object):
                         )
 
                     # Build byproduct flows
-                    if i.get("sub_products", None) and subproduct_model:
-                        for j in subproduct_model.browse(i["sub_products"]).read(
-                            subproduct_fields
-                        ):
-                            product = self.product_product.get(j["product_id"][0], None)
-                            if not product:
-                                continue
-                            yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
-                                (
-                                    "flow_fixed_end"
-                                    if j["subproduct_type"] == "fixed"
-                                    else "flow_end"
-                                ),
-                                self.convert_qty_uom(
-                                    j["product_qty"],
-                                    j["product_uom"][0],
-                                    j["product_id"][0],
-                                ),
-                                quoteattr(product["name"]),
-                            )
+                    for j in byproducts:
+                        product = self.product_product.get(j["product_id"][0], None)
+                        if not product:
+                            continue
+                        yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
+                            (
+                                "flow_fixed_end"
+                                if j["subproduct_type"] == "fixed"
+                                else "flow_end"
+                            ),
+                            self.convert_qty_uom(
+                                j["product_qty"],
+                                j["product_uom"][0],
+                                j["product_id"][0],
+                            ),
+                            quoteattr(product["name"]),
+                        )
                     yield "</flows>\n"
 
                     # Create loads
@@ -1080,8 +2406,9 @@ class exporter(object):
                         suboperation = step[3]
                         yield "<suboperation>" '<operation name=%s priority="%s" duration_per="%s" xsi:type="operation_time_per">\n' "<location name=%s/>\n" '<loads><load quantity="%f"><resource name=%s/></load></loads>\n' % (
                             quoteattr(
-                                "%s - %s - %s"
-                                % (operation, suboperation, (counter * 100))
+                                self.operation_registry.add_step(
+                                    registered, suboperation, counter * 100
+                                )
                             ),
                             counter * 10,
                             self.convert_float_time(step[1]),
@@ -1093,42 +2420,37 @@ class exporter(object):
                             # Add producing flows on the last routing step
                             yield '<flows>\n<flow xsi:type="flow_end" quantity="%f"><item name=%s/></flow>\n' % (
                                 i["product_qty"]
-                                * getattr(i, "product_efficiency", 1.0)
+                                * i.get("product_efficiency", 1.0)
                                 * uom_factor,
                                 quoteattr(product_buf["name"]),
                             )
-                            self.bom_producedQty[
-                                ("%s - %s" % (operation, step[2]), product_buf["name"])
-                            ] = (
+                            registered["produced_qty"] = (
                                 i["product_qty"]
-                                * getattr(i, "product_efficiency", 1.0)
+                                * i.get("product_efficiency", 1.0)
                                 * uom_factor
                             )
                             # Add byproduct flows
-                            if i.get("sub_products", None):
-                                for j in subproduct_model.browse(
-                                    i["sub_products"]
-                                ).read(subproduct_fields):
-                                    product = self.product_product.get(
-                                        j["product_id"][0], None
-                                    )
-                                    if not product:
-                                        continue
-                                    yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
-                                        (
-                                            "flow_fixed_end"
-                                            if j["subproduct_type"] == "fixed"
-                                            else "flow_end"
-                                        ),
-                                        self.convert_qty_uom(
-                                            j["product_qty"],
-                                            j["product_uom"][0],
-                                            self.product_product[j["product_id"][0]][
-                                                "template"
-                                            ],
-                                        ),
-                                        quoteattr(product["name"]),
-                                    )
+                            for j in byproducts:
+                                product = self.product_product.get(
+                                    j["product_id"][0], None
+                                )
+                                if not product:
+                                    continue
+                                yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
+                                    (
+                                        "flow_fixed_end"
+                                        if j["subproduct_type"] == "fixed"
+                                        else "flow_end"
+                                    ),
+                                    self.convert_qty_uom(
+                                        j["product_qty"],
+                                        j["product_uom"][0],
+                                        self.product_product[j["product_id"][0]][
+                                            "template"
+                                        ],
+                                    ),
+                                    quoteattr(product["name"]),
+                                )
                             yield "</flows>\n"
                         if counter == 1:
                             # All consuming flows on the first routing step.
@@ -1136,13 +2458,11 @@ class exporter(object):
                             # we sum up all quantities in a single flow. We assume all of them
                             # have the same effectivity.
                             fl = {}
-                            for j in bom_lines_model.browse(i["bom_line_ids"]).read(
-                                bom_lines_fields
-                            ):
+                            for j in lines:
                                 # check if this BOM line applies to this variant
-                                if len(j["attribute_value_ids"]) > 0 and not all(
-                                    elem in product_buf["attribute_value_ids"]
-                                    for elem in j["attribute_value_ids"]
+                                if (
+                                    j["attribute_value_ids"]
+                                    and not j["attribute_value_ids"] <= variant_values
                                 ):
                                     continue
                                 product = self.product_product.get(
@@ -1175,6 +2495,9 @@ class exporter(object):
                         yield "</operation></suboperation>\n"
                     yield "</suboperations>\n"
                 yield "</operation>\n"
+                self.exported("operation", operation_key)
+        for name in self.deleted_records("operation"):
+            yield '<operation name=%s action="R"/>\n' % quoteattr(name)
         yield "</operations>\n"
 
     def export_transferorders(self):
@@ -1192,70 +2515,102 @@ class exporter(object):
         """
         # Get all sales order lines
         # _log_logging(self.env, 'begin', "Sync WT: begin", '1')
-        m = self.env["transfer.order.line"]
         filter_state = ["draft", "transfer"]
-        recs = m.search(
-            [
-                ("product_id", "!=", False),
-                ("transfer_id.state", "in", filter_state),
-                ("sync_to_frepple", "=", True),
-            ]
+        # All related records are read in bulk: the transfer order lines, their
+        # sales order lines, the transfer orders and their sales orders.
+        fields = [
+            "state",
+            "product_id",
+            "product_uom_qty",
+            "product_uom",
+            "transfer_id",
+            "sale_line_id",
+        ]
+        lines = list(
+            self.generator.getData(
+                "transfer.order.line",
+                search=[
+                    ("product_id", "!=", False),
+                    ("transfer_id.state", "in", filter_state),
+                    ("sync_to_frepple", "=", True),
+                ],
+                fields=fields,
+            )
         )
-        # fields = [
-        #     "state",
-        #     "product_id",
-        #     "product_uom_qty",
-        #     "product_uom",
-        #     "transfer_id",
-        #     "sale_line_id"
-        # ]
+        ids = list({i["sale_line_id"][0] for i in lines if i["sale_line_id"]})
+        sale_lines = {
+            i["id"]: i
+            for i in self.generator.getData(
+                "sale.order.line", ids=ids, fields=["qty_delivered", "bom_id"]
+            )
+        }
         so_line = []
-        for i in recs:
-            each_line = {
-                "state": i.state,
-                "product_id": [i.product_id.id, i.product_id.name],
-                "product_uom_qty": i.product_uom_qty,
-                "product_uom": [i.product_uom.id, i.product_uom.name],
-                "order_id": [i.transfer_id.id, i.transfer_id.name],
-                "qty_delivered": i.sale_line_id.qty_delivered,
-                "bom_id": i.sale_line_id.bom_id,
-                "id": i.id,
-            }
-            so_line.append(each_line)
+        for i in lines:
+            sale_line = (
+                sale_lines.get(i["sale_line_id"][0], None)
+                if i["sale_line_id"]
+                else None
+            )
+            so_line.append(
+                {
+                    "state": i["state"],
+                    "product_id": i["product_id"],
+                    "product_uom_qty": i["product_uom_qty"],
+                    "product_uom": i["product_uom"],
+                    "order_id": i["transfer_id"],
+                    "qty_delivered": sale_line["qty_delivered"] if sale_line else 0.0,
+                    "bom_id": sale_line["bom_id"] if sale_line else False,
+                    "id": i["id"],
+                }
+            )
         # _log_logging(self.env, str(so_line), "Sync WT: get WT line", '2')
-        # so_line = [i for i in recs.read(fields)]
 
-        # Get all sales orders
-        m = self.env["transfer.order"]
-        ids = [i["order_id"][0] for i in so_line]
+        # Get all transfer orders
+        ids = list({i["order_id"][0] for i in so_line})
         logger.error(
             "==== WT: done construct WT line. transfers data: %s, type %s"
             % (len(ids), type(ids))
         )
         fields = [
+            "name",
             "state",
-            "partner_id",
+            "sale_order_id",
             "date_requested",
-            "date_order",
             "picking_policy",
             "warehouse_id",
             "picking_ids",
         ]
+        transfers = list(
+            self.generator.getData("transfer.order", ids=ids, fields=fields)
+        )
+        ids = list({i["sale_order_id"][0] for i in transfers if i["sale_order_id"]})
+        sale_orders = {
+            i["id"]: i
+            for i in self.generator.getData(
+                "sale.order", ids=ids, fields=["partner_id", "date_order"]
+            )
+        }
         so = {}
-        for i in m.browse(ids):
-            so[i.id] = {
-                "state": i.state,
-                "partner_id": [
-                    i.sale_order_id.partner_id.id,
-                    i.sale_order_id.partner_id.name,
-                ],
-                "requested_date": i.date_requested,
-                "date_order": i.sale_order_id.date_order,
-                "picking_policy": i.picking_policy,
-                "warehouse_id": [i.warehouse_id.id, i.warehouse_id.name],
-                "picking_ids": i.picking_ids.ids,
+        for i in transfers:
+            sale_order = (
+                sale_orders.get(i["sale_order_id"][0], None)
+                if i["sale_order_id"]
+                else None
+            )
+            so[i["id"]] = {
+                "name": i["name"],
+                "state": i["state"],
+                "partner_id": (
+                    sale_order["partner_id"]
+                    if sale_order and sale_order["partner_id"]
+                    else [False, False]
+                ),
+                "requested_date": i["date_requested"],
+                "date_order": sale_order["date_order"] if sale_order else False,
+                "picking_policy": i["picking_policy"],
+                "warehouse_id": i["warehouse_id"] or [False, False],
+                "picking_ids": i["picking_ids"],
             }
-            # so[i["id"]] = i
 
         # _log_logging(self.env, str(so), "Sync WT: get WT", '3')
         logger.error("==== WT: done construct WT.")
@@ -1264,9 +2619,9 @@ class exporter(object):
         yield "<demands>\n"
 
         for i in so_line:
-            name = "%s %d" % (i["order_id"][1], i["id"])
-            product = self.product_product.get(i["product_id"][0], None)
             j = so[i["order_id"][0]]
+            name = "%s %d" % (j["name"], i["id"])
+            product = self.product_product.get(i["product_id"][0], None)
             location = self.map_locations.get(j["warehouse_id"][0], None)
             customer = self.map_customers.get(j["partner_id"][0], None)
             if not customer or not location or not product:
@@ -1282,18 +2637,16 @@ class exporter(object):
             # if a BOM is defined, we need to use it as delivery operation
             operation = None
             if i.get("bom_id", False):
-                # build operation name
-                operation = "%d %s @ %s" % (
-                    i["bom_id"]["id"],
-                    product["name"],
-                    location,
+                registered = self.operation_registry.operations.get(
+                    (i["bom_id"][0], i["product_id"][0]), None
                 )
-                if operation not in self.operations:
+                if registered and registered["location"] == location:
+                    operation = registered["name"]
+                else:
                     logger.error(
                         "sales order line with id %s cannot use unknow bom %s"
-                        % (i["id"], operation)
+                        % (i["id"], i["bom_id"][0])
                     )
-                    operation = None
 
             # Possible sales order status are 'draft', 'sent', 'sale', 'done' and 'cancel'
             state = j.get("state", "sale")
@@ -1391,7 +2744,7 @@ class exporter(object):
                 quoteattr(customer),
                 quoteattr(location),
                 ("<operation name=%s/>" % (quoteattr(operation),)) if operation else "",
-                quoteattr(i["order_id"][1]),
+                quoteattr(j["name"]),
                 "alltogether" if j["picking_policy"] == "one" else "independent",
             )
 
@@ -1425,8 +2778,6 @@ class exporter(object):
         (if sale.order.picking_policy = 'one' then same as demand.quantity else 1) -> demand.minshipment
         """
         # Get all sales order lines
-        m = self.env["sale.order.line"]
-        recs = m.search([("product_id", "!=", False), ("order_id.state", "=", "sale")])
         fields = [
             "qty_delivered",
             "state",
@@ -1437,12 +2788,17 @@ class exporter(object):
             "bom_id",
         ]
         so_line = [
-            i for i in recs.read(fields) if i["qty_delivered"] < i["product_uom_qty"]
+            i
+            for i in self.generator.getData(
+                "sale.order.line",
+                search=[("product_id", "!=", False), ("order_id.state", "=", "sale")],
+                fields=fields,
+            )
+            if i["qty_delivered"] < i["product_uom_qty"]
         ]
 
         # Get all sales orders
-        m = self.env["sale.order"]
-        ids = [i["order_id"][0] for i in so_line]
+        ids = list({i["order_id"][0] for i in so_line})
         fields = [
             "state",
             "partner_id",
@@ -1454,15 +2810,13 @@ class exporter(object):
             "priority",
         ]
         so = {}
-        for i in m.browse(ids).read(fields):
+        for i in self.generator.getData("sale.order", ids=ids, fields=fields):
             so[i["id"]] = i
 
         # Generate the demand records
         yield "<!-- sales order lines -->\n"
         yield "<demands>\n"
 
-        bom_dict = {int(i.split()[0]): i for i in self.operations}
-
         for i in so_line:
             name = "%s %d" % (i["order_id"][1], i["id"])
             product = self.product_product.get(i["product_id"][0], None)
@@ -1483,8 +2837,16 @@ class exporter(object):
             # if a BOM is defined, we need to use it as delivery operation
             operation = None
             if i.get("bom_id", False):
-                # build operation name
-                operation = bom_dict.get(i["bom_id"][0], False)
+                registered = self.operation_registry.get(
+                    i["bom_id"][0], i["product_id"][0]
+                )
+                if registered:
+                    operation = registered["name"]
+                else:
+                    logger.warning(
+                        "No operation for bom %s and product %s of sales order line %s"
+                        % (i["bom_id"][0], i["product_id"][0], i["id"])
+                    )
 
             # Possible sales order status are 'draft', 'sent', 'sale', 'done' and 'cancel'
             state = j.get("state", "sale")
@@ -1602,18 +2964,6 @@ class exporter(object):
         'PO' -> operationplan.ordertype
         'confirmed' -> operationplan.status
         """
-        m = self.env["purchase.order.line"]
-        recs = m.search(
-            [
-                "|",
-                (
-                    "order_id.state",
-                    "not in",
-                    ("draft", "sent", "bid", "confirmed", "cancel"),
-                ),
-                ("order_id.state", "=", False),
-            ]
-        )
         fields = [
             "name",
             "date_planned",
@@ -1623,12 +2973,26 @@ class exporter(object):
             "product_uom",
             "order_id",
             "state",
+            "write_date",
         ]
-        po_line = [i for i in recs.read(fields)]
+        po_line = list(
+            self.generator.getData(
+                "purchase.order.line",
+                search=[
+                    "|",
+                    (
+                        "order_id.state",
+                        "not in",
+                        ("draft", "sent", "bid", "confirmed", "cancel"),
+                    ),
+                    ("order_id.state", "=", False),
+                ],
+                fields=fields,
+            )
+        )
 
         # Get all purchase orders
-        m = self.env["purchase.order"]
-        ids = [i["order_id"][0] for i in po_line]
+        ids = list({i["order_id"][0] for i in po_line})
         fields = [
             "name",
             "company_id",
@@ -1636,9 +3000,10 @@ class exporter(object):
             "state",
             "date_order",
             "warehouse_id",
+            "write_date",
         ]
         po = {}
-        for i in m.browse(ids).read(fields):
+        for i in self.generator.getData("purchase.order", ids=ids, fields=fields):
             po[i["id"]] = i
 
         accepted_location = [
@@ -1665,14 +3030,13 @@ class exporter(object):
                 continue
 
             if location and item and i["product_qty"] > i["qty_received"]:
-                start = str(
-                    timezone("UTC").localize(j["date_order"]).astimezone(timezone("NZ"))
-                ).replace(" ", "T")[:19]
-                end = str(
-                    timezone("UTC")
-                    .localize(i["date_planned"])
-                    .astimezone(timezone("NZ"))
-                ).replace(" ", "T")[:19]
+                reference = "%s - %s" % (j["name"], i["id"])
+                if not self.is_changed(
+                    "PO", i["id"], reference, i["write_date"], j["write_date"]
+                ):
+                    continue
+                start = self.dates.format_utc(j["date_order"], "NZ")
+                end = self.dates.format_utc(i["date_planned"], "NZ")
 
                 qty = self.convert_qty_uom(
                     i["product_qty"] - i["qty_received"],
@@ -1680,7 +3044,7 @@ class exporter(object):
                     self.product_product[i["product_id"][0]]["template"],
                 )
                 yield '<operationplan reference=%s ordertype="PO" start="%s" end="%s" quantity="%f" status="confirmed">' "<item name=%s/><location name=%s/><supplier name=%s/>" % (
-                    quoteattr("%s - %s" % (j["name"], i["id"])),
+                    quoteattr(reference),
                     start,
                     end,
                     qty,
@@ -1689,6 +3053,11 @@ class exporter(object):
                     quoteattr("%d %s" % (j["partner_id"][0], j["partner_id"][1])),
                 )
                 yield "</operationplan>\n"
+                self.exported("PO", i["id"])
+        for name in self.deleted_records("PO"):
+            yield '<operationplan reference=%s ordertype="PO" action="R"/>\n' % (
+                quoteattr(name)
+            )
         yield "</operationplans>\n"
 
     def export_manufacturingorders(self):
@@ -1706,13 +3075,6 @@ class exporter(object):
         """
         yield "<!-- manufacturing orders in progress -->\n"
         yield "<operationplans>\n"
-        m = self.env["mrp.production"]
-        recs = m.search(
-            [
-                ("state", "in", ["confirmed", "planned", "progress"]),
-                # ("origin", "=ilike", "%TRANS%"),
-            ]
-        )
         fields = [
             "bom_id",
             "date_start",
@@ -1725,9 +3087,9 @@ class exporter(object):
             "product_id",
             "origin",
             "priority",
+            "write_date",
         ]
 
-        bom_dict = {int(i.split()[0]): i for i in self.operations}
         priority_dict = {
             "0": "Not urgent",
             "1": "Normal",
@@ -1735,7 +3097,14 @@ class exporter(object):
             "3": "Very urgent",
         }
 
-        for i in recs.read(fields):
+        for i in self.generator.getData(
+            "mrp.production",
+            search=[
+                ("state", "in", ["confirmed", "planned", "progress"]),
+                # ("origin", "=ilike", "%TRANS%"),
+            ],
+            fields=fields,
+        ):
             if i["bom_id"]:
                 # Open orders
                 location = self.map_locations.get(i["location_dest_id"][0], None)
@@ -1753,30 +3122,31 @@ class exporter(object):
                 )
                 if not item:
                     continue
-                operation = bom_dict.get(i["bom_id"][0], False)
+                registered = self.operation_registry.get(
+                    i["bom_id"][0], i["product_id"][0]
+                )
                 origin = i["origin"]
                 if origin:
                     origin = origin.split(", ")
                     origin = " ".join([j for j in origin if j.startswith("S")])
                 try:
-                    startdate = str(
-                        timezone("UTC")
-                        .localize(i["date_start"])
-                        .astimezone(timezone("NZ"))
-                        if i["date_start"]
-                        else timezone("UTC")
-                        .localize(i["date_planned_start"])
-                        .astimezone(timezone("NZ"))
-                    ).replace(" ", "T")[:19]
+                    startdate = self.dates.format_utc(
+                        i["date_start"] or i["date_planned_start"], "NZ"
+                    )
                 except Exception:
                     continue
-                if not location or operation not in self.operations:
+                if not location:
                     continue
-                factor = (
-                    self.bom_producedQty[(operation, item["name"])]
-                    if (operation, i["name"]) in self.bom_producedQty
-                    else 1
-                )
+                if not registered:
+                    logger.warning(
+                        "No operation for bom %s and product %s of manufacturing order %s"
+                        % (i["bom_id"][0], i["product_id"][0], i["name"])
+                    )
+                    continue
+                if not self.is_changed("MO", i["id"], i["name"], i["write_date"]):
+                    continue
+                operation = registered["name"]
+                factor = registered["produced_qty"] or 1
                 qty = (
                     self.convert_qty_uom(
                         i["product_qty"],
@@ -1799,6 +3169,11 @@ class exporter(object):
                         else "Normal"
                     ),
                 )
+                self.exported("MO", i["id"])
+        for name in self.deleted_records("MO"):
+            yield '<operationplan reference=%s ordertype="MO" action="R"/>\n' % (
+                quoteattr(name)
+            )
         yield "</operationplans>\n"
 
     def export_orderpoints(self):
@@ -1815,8 +3190,6 @@ class exporter(object):
         convert stock.warehouse.orderpoint.qty_multiple -> buffer->size_multiple
         """
 
-        m = self.env["stock.warehouse.orderpoint"]
-        recs = m.search([])
         fields = [
             "warehouse_id",
             "product_id",
@@ -1825,10 +3198,11 @@ class exporter(object):
             "product_uom",
             "qty_multiple",
         ]
+        recs = peek(self.generator.getData("stock.warehouse.orderpoint", fields=fields))
         if recs:
             yield "<!-- order points -->\n"
             yield "<calendars>\n"
-            for i in recs.read(fields):
+            for i in recs:
                 item = self.product_product.get(
                     i["product_id"] and i["product_id"][0] or 0, None
                 )
@@ -1876,31 +3250,63 @@ class exporter(object):
         """
         yield "<!-- inventory -->\n"
         yield "<buffers>\n"
-        self.env.cr.execute(
-            "SELECT product_id, location_id, sum(quantity) "
-            "FROM stock_quant "
-            "WHERE quantity > 0 "
-            "GROUP BY product_id, location_id "
-            "ORDER BY location_id ASC"
-        )
-        inventory = {}
-        for i in self.env.cr.fetchall():
-            item = self.product_product.get(i[0], None)
-            location = self.map_locations.get(i[1], None)
-            if item and location:
-                inventory[(item["name"], location)] = i[2] + inventory.get(
-                    (item["name"], location), 0
-                )
-        for key, val in inventory.items():
-            buf = "%s @ %s" % (key[0], key[1])
+        # The quants are rolled up to the warehouse in the database: a location
+        # belongs to the warehouse with the nearest view location among its
+        # ancestors. Archived locations are skipped, like the ORM does.
+        # The result is read in batches with a server-side cursor, ordered by
+        # warehouse, so only the inventory of a single warehouse is kept in
+        # memory. It is a dictionary because different products can have the
+        # same name.
+        # The name of the cursor is unique within the database connection,
+        # which other exports can be using at the same time.
+        cursor = self.env.cr._cnx.cursor("frepple_onhand_%s" % uuid.uuid4().hex)
+        try:
+            cursor.execute(
+                "WITH location_warehouse AS ("
+                "SELECT DISTINCT ON (loc.id) loc.id AS location_id, wh.name "
+                "FROM stock_location loc "
+                "INNER JOIN stock_location view "
+                "ON loc.parent_path LIKE view.parent_path || '%%' "
+                "INNER JOIN stock_warehouse wh ON wh.view_location_id = view.id "
+                "WHERE view.id = ANY(%s) AND loc.active "
+                "ORDER BY loc.id, length(view.parent_path) DESC"
+                ") "
+                "SELECT location_warehouse.name, quant.product_id, sum(quant.quantity) "
+                "FROM stock_quant quant "
+                "INNER JOIN location_warehouse "
+                "ON location_warehouse.location_id = quant.location_id "
+                "WHERE quant.quantity > 0 "
+                "GROUP BY location_warehouse.name, quant.product_id "
+                "ORDER BY location_warehouse.name, quant.product_id",
+                (self.warehouse_views,),
+            )
+            location = None
+            inventory = {}
+            while True:
+                rows = cursor.fetchmany(self.generator.pagesize)
+                self.generator.rows += len(rows)
+                for i in rows:
+                    if i[0] != location:
+                        for j in self.onhand_buffers(location, inventory):
+                            yield j
+                        location = i[0]
+                        inventory = {}
+                    item = self.product_product.get(i[1], None)
+                    if item:
+                        inventory[item["name"]] = i[2] + inventory.get(item["name"], 0)
+                if not rows:
+                    break
+            for j in self.onhand_buffers(location, inventory):
+                yield j
+        finally:
+            cursor.close()
+        yield "</buffers>\n"
 
-            # there is a weird case possibly related to the data, key[1] is should be location but i has value -1
-            if key[1] == -1:
-                continue
+    def onhand_buffers(self, location, inventory):
+        for item, val in inventory.items():
             yield '<buffer name=%s onhand="%f"><item name=%s/><location name=%s/></buffer>\n' % (
-                quoteattr(buf),
+                quoteattr("%s @ %s" % (item, location)),
                 val,
-                quoteattr(key[0]),
-                quoteattr(key[1]),
+                quoteattr(item),
+                quoteattr(location),
             )
-        yield "</buffers>\n"
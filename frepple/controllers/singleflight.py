@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+logger = logging.getLogger(__name__)
+
+# File locks are only available on unix: elsewhere requests are only shared
+# within a process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SingleFlight(object):
+    """
+    Shares a single export between identical requests running at the same
+    time.
+
+    Within a process the requests arriving while an export is in progress
+    wait for it and get the same file. Across processes a file lock per
+    request key serializes the exports: a process that had to wait for the
+    lock uses the file generated by the other process when that export
+    finished after the request arrived.
+
+    A request doesn't wait longer than the timeout: it then generates the
+    export itself, such that a hung export doesn't block the others.
+    """
+
+    # Folder with the lock and the latest result per request key
+    folder = os.path.join(str(Path.home()), "logs", "frepple", "locks")
+
+    # Default number of seconds a request waits for an identical export
+    timeout = 900
+
+    # Number of seconds between the attempts to get the lock of another
+    # process
+    poll_interval = 0.5
+
+    # Exports in progress in this process
+    flights = {}
+    lock = threading.Lock()
+
+    def __init__(self, key):
+        self.key = key
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    @classmethod
+    def run(cls, key, function, timeout=None):
+        """
+        Returns the name of the file generated by the function, which is only
+        called when no export with the same key is in progress or when the
+        export in progress doesn't finish within the timeout in seconds.
+        """
+        started = time.time()
+        deadline = started + (cls.timeout if timeout is None else timeout)
+        key = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        with cls.lock:
+            flight = cls.flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = cls.flights[key] = cls(key)
+        if not leader:
+            logger.info("Waiting for the identical export in progress")
+            if not flight.event.wait(deadline - started):
+                logger.warning(
+                    "Identical export still in progress after %s seconds: "
+                    "generating the export again" % round(deadline - started)
+                )
+                return function()
+            if flight.error:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = flight.execute(function, started, deadline)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with cls.lock:
+                del cls.flights[key]
+            flight.event.set()
+
+    def execute(self, function, started, deadline):
+        if not fcntl:
+            return function()
+        os.makedirs(self.folder, exist_ok=True)
+        lockname = os.path.join(self.folder, "%s.lock" % self.key)
+        while True:
+            with open(lockname, "a") as lockfile:
+                if not self.acquire(lockfile, deadline):
+                    logger.warning(
+                        "Identical export of another process still in progress "
+                        "after %s seconds: generating the export again"
+                        % round(deadline - started)
+                    )
+                    return function()
+                try:
+                    # The process that held the lock removes the file: the
+                    # lock is only valid on the file that is still in place
+                    if os.path.samestat(os.fstat(lockfile.fileno()), os.stat(lockname)):
+                        # Generated by another process after the request
+                        # arrived
+                        result = self.read_result(started)
+                        if result:
+                            return result
+                        result = function()
+                        self.write_result(result)
+                        return result
+                except FileNotFoundError:
+                    pass
+                finally:
+                    self.release(lockfile, lockname)
+
+    def acquire(self, lockfile, deadline):
+        """
+        Locks the file, polling until the deadline. Returns False when the
+        lock isn't free by then.
+        """
+        logged = False
+        while True:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    return False
+                if not logged:
+                    logger.info("Waiting for the identical export of another process")
+                    logged = True
+                time.sleep(self.poll_interval)
+
+    def release(self, lockfile, lockname):
+        """
+        Removes the lock file and unlocks it. Processes waiting for the lock
+        notice that the file was removed, and lock a new one.
+        """
+        try:
+            if os.path.samestat(os.fstat(lockfile.fileno()), os.stat(lockname)):
+                os.remove(lockname)
+        except OSError:
+            pass
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    @classmethod
+    def cleanup(cls, retention):
+        """
+        Removes the results older than the retention period in seconds, and
+        the lock files that processes stopped while holding them left behind.
+        """
+        limit = time.time() - retention
+        try:
+            names = os.listdir(cls.folder)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(cls.folder, name)
+            try:
+                if os.path.getmtime(path) >= limit:
+                    continue
+                if name.endswith(".lock") and fcntl:
+                    # Only when no export holds it
+                    with open(path, "a") as lockfile:
+                        try:
+                            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        cls(name[:-5]).release(lockfile, path)
+                else:
+                    os.remove(path)
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+
+    def read_result(self, started):
+        try:
+            with open(os.path.join(self.folder, "%s.json" % self.key), "r") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if result["finished"] >= started and os.path.isfile(result["file"]):
+            return result["file"]
+        return None
+
+    def write_result(self, filename):
+        with NamedTemporaryFile(mode="w", dir=self.folder, delete=False) as f:
+            json.dump({"file": filename, "finished": time.time()}, f)
+        os.replace(f.name, os.path.join(self.folder, "%s.json" % self.key))
+
+
+def cleanup(folder, retention):
+    """
+    Removes the files in a folder that are older than the retention period
+    in seconds. Files that are still being generated or sent are recent.
+    """
+    limit = time.time() - retention
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            # Removed by another process in the meantime
+            pass
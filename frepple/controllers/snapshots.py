@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+logger = logging.getLogger(__name__)
+
+
+class ExportSnapshot(object):
+    """
+    A pre-generated export, stored on disk.
+
+    A snapshot belongs to the user, the company, the mode, the language and
+    the other settings of the exporter that generated it, as returned by its
+    snapshot_settings method. It is only served to an exporter with exactly
+    the same settings, such that a request never gets data its user can't
+    read or a document generated differently.
+
+    Every version is stored in a file named after the fingerprint of the data
+    it was generated from, which is also its ETag. The file latest.json
+    refers to the most recent version and records when it was generated.
+    """
+
+    # Folder with a subfolder per database, company and settings
+    folder = os.path.join(str(Path.home()), "logs", "frepple", "snapshots")
+
+    # Number of versions kept, including the latest one. Older versions are
+    # kept for a while for clients still downloading them.
+    versions = 2
+
+    def __init__(self, xp):
+        self.xp = xp
+        self.settings = xp.snapshot_settings()
+        self.path = os.path.join(
+            self.folder,
+            (xp.database or "").replace("/", "_"),
+            (xp.company or "").replace("/", "_"),
+            hashlib.sha1(
+                json.dumps(self.settings, sort_keys=True).encode("utf-8")
+            ).hexdigest(),
+        )
+
+    def latest(self):
+        """
+        Returns the metadata of the most recent version, or None if there is
+        no version yet.
+        """
+        try:
+            with open(os.path.join(self.path, "latest.json"), "r") as f:
+                latest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if latest.get("settings", None) != self.settings:
+            return None
+        latest["file"] = os.path.join(self.path, "%s.xml" % latest["etag"])
+        if not os.path.isfile(latest["file"]):
+            return None
+        return latest
+
+    def set_latest(self, etag, created):
+        with NamedTemporaryFile(mode="w", dir=self.path, delete=False) as f:
+            json.dump({"etag": etag, "created": created, "settings": self.settings}, f)
+        os.replace(f.name, os.path.join(self.path, "latest.json"))
+
+    def generate(self):
+        """
+        Generates a new version when the data changed since the latest one.
+        Otherwise the latest version is marked as generated now. The exporter
+        must not record watermarks.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # Taken before the export: changes made while it runs result in a
+        # new version at the next run
+        etag = self.xp.data_fingerprint()
+        created = time.time()
+        latest = self.latest()
+        if latest and latest["etag"] == etag:
+            self.set_latest(etag, created)
+            return
+        with NamedTemporaryFile(mode="w+b", dir=self.path, delete=False) as f:
+            try:
+                for i in self.xp.run_chunked():
+                    f.write(i.encode("utf-8"))
+            except Exception:
+                os.remove(f.name)
+                raise
+        os.replace(f.name, os.path.join(self.path, "%s.xml" % etag))
+        self.set_latest(etag, created)
+        logger.info(
+            "Generated frePPLe snapshot %s of company %s mode %s for user %s"
+            % (etag, self.xp.company, self.xp.mode, self.xp.env.uid)
+        )
+
+        # Remove the old versions
+        old = sorted(
+            (
+                os.path.join(self.path, i)
+                for i in os.listdir(self.path)
+                if i.endswith(".xml")
+            ),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for i in old[self.versions :]:
+            try:
+                os.remove(i)
+            except OSError:
+                pass
@@ -1,2 +1,5 @@
 from . import res_company
 from . import res_config_settings
+from . import export_watermark
+from . import export_snapshot
+from . import export_job
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+
+from odoo import api, models, tools
+
+from odoo.addons.frepple.controllers.frepplexml import XMLController
+from odoo.addons.frepple.controllers.jobs import ExportJob
+
+_logger = logging.getLogger(__name__)
+
+
+class ExportJobRunner(models.AbstractModel):
+    """
+    Generates the exports queued with the async=1 argument. Called by a
+    scheduled action, such that the limits of the HTTP workers don't apply.
+
+    With a multi-process server the cron workers have limits of their own:
+    the real time limit limit_time_real_cron, which defaults to
+    limit_time_real, and the memory limit limit_memory_hard. Long exports
+    need limit_time_real_cron set to 0 or to a large value. A job stopped by
+    a limit is reported as failed.
+    """
+
+    _name = "frepple.export.job"
+    _description = "frePPLe export jobs"
+
+    @api.model
+    def run_jobs(self):
+        retention = (
+            self.env["ir.config_parameter"].sudo().get_param("frepple.retention")
+        )
+        ExportJob.cleanup(int(retention) if retention else XMLController.retention)
+        controller = XMLController()
+        warning = self.check_limits()
+        for job in ExportJob.queued(self.env.cr.dbname):
+            if job.claim():
+                _logger.info("Running frePPLe export job %s" % job.id)
+                if warning:
+                    _logger.warning(warning)
+                    job.update(warning=warning)
+                job.run(controller.run_job)
+
+    @api.model
+    def check_limits(self):
+        """
+        Returns a warning when the cron workers stop jobs running longer than
+        a limit, or None. The threaded server has no such limit.
+        """
+        if not tools.config["workers"]:
+            return None
+        limit = tools.config.get("limit_time_real_cron", -1)
+        if limit is None or limit < 0:
+            limit = tools.config["limit_time_real"]
+        if not limit:
+            return None
+        return (
+            "Export jobs are stopped after %s seconds: set limit_time_real_cron "
+            "to 0 or to a large value in the Odoo configuration" % limit
+        )
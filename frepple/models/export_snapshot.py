@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+from types import SimpleNamespace
+
+from odoo import SUPERUSER_ID, api, models
+
+from odoo.addons.frepple.controllers.outbound import exporter
+from odoo.addons.frepple.controllers.snapshots import ExportSnapshot
+
+_logger = logging.getLogger(__name__)
+
+
+class ExportSnapshotGenerator(models.AbstractModel):
+    """
+    Pre-generates the export of every company of the connector user, such
+    that frePPLe can download it without waiting. Called by a scheduled
+    action, which must run as the connector user: the snapshots are only
+    served to the user that generated them.
+
+    The modes are set in the system parameter frepple.snapshot_modes, as a
+    comma separated list (default 1). The snapshots use the default settings
+    of a request: the language of the user and the calendar horizon of the
+    system parameter frepple.calendar_horizon.
+    """
+
+    _name = "frepple.export.snapshot"
+    _description = "frePPLe export snapshots"
+
+    @api.model
+    def generate_snapshots(self):
+        if self.env.uid == SUPERUSER_ID:
+            _logger.warning(
+                "frePPLe snapshots are not generated as the superuser: "
+                "run the scheduled action as the connector user"
+            )
+            return
+        params = self.env["ir.config_parameter"].sudo()
+        modes = params.get_param("frepple.snapshot_modes", "1")
+        calendar_horizon = params.get_param("frepple.calendar_horizon")
+        user = self.env.user
+        # The context of a request to the connector
+        env = self.env(context=dict(self.env.context, lang=user.lang, tz=user.tz))
+        for company in user.company_ids:
+            for mode in modes.split(","):
+                try:
+                    # The exporter only uses the environment of the request
+                    xp = exporter(
+                        SimpleNamespace(env=env),
+                        uid=env.uid,
+                        database=env.cr.dbname,
+                        company=company.name,
+                        mode=int(mode),
+                        calendar_horizon=(
+                            int(calendar_horizon) if calendar_horizon else None
+                        ),
+                        watermarks=False,
+                    )
+                    ExportSnapshot(xp).generate()
+                except Exception:
+                    _logger.exception(
+                        "Error generating frePPLe snapshot of company %s mode %s"
+                        % (company.name, mode)
+                    )
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from odoo import fields, models
+
+
+class ExportWatermark(models.Model):
+    """
+    Bookkeeping for the incremental export (mode 3) of the connector.
+
+    For every company and entity type we remember when the last successful
+    export started and which records were sent to frePPLe at that time.
+    """
+
+    _name = "frepple.export.watermark"
+    _description = "frePPLe export watermark"
+
+    company_id = fields.Many2one(
+        "res.company", "Company", required=True, ondelete="cascade"
+    )
+    entity = fields.Char("Entity", required=True)
+    watermark = fields.Datetime("Watermark")
+    # JSON dictionary with the odoo key and the frePPLe name of all
+    # records exported by the last run.
+    exported_keys = fields.Text("Exported keys")
+
+    _sql_constraints = [
+        (
+            "company_entity_uniq",
+            "unique(company_id, entity)",
+            "Only one watermark per company and entity is allowed",
+        )
+    ]
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import base64
+import json
+import os
+import shutil
+import socket
+import tempfile
+from unittest.mock import patch
+
+from odoo import tools
+from odoo.tests import common, tagged
+from odoo.tests.common import HOST, PORT
+
+from odoo.addons.frepple.controllers.frepplexml import XMLController
+from odoo.addons.frepple.controllers.jobs import ExportJob
+
+
+class JobFolder(object):
+    """
+    Keeps the jobs of a test in a temporary folder.
+    """
+
+    def setUp(self):
+        super(JobFolder, self).setUp()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        patcher = patch.object(ExportJob, "folder", folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enqueue(self, uid, **options):
+        """
+        Queues an export of the main company, like a request with async=1.
+        """
+        options.setdefault("mode", 1)
+        options.setdefault("use_cache", False)
+        res = XMLController().enqueue(
+            self.env.cr.dbname,
+            uid,
+            {"lang": "en_US"},
+            [self.env.ref("base.main_company").name],
+            options,
+            chunk_size=None,
+            encoding=None,
+            level=None,
+            mimetype="application/xml;charset=utf8",
+        )
+        self.assertEqual(res.status_code, 202)
+        return ExportJob(json.loads(res.get_data())["job"])
+
+
+@tagged("post_install", "-at_install")
+class TestExportJob(JobFolder, common.TransactionCase):
+    def test_claim(self):
+        job = self.enqueue(self.env.uid)
+        self.assertEqual(ExportJob.queued(self.env.cr.dbname), [job])
+        self.assertEqual(ExportJob.queued("other database"), [])
+        # Only one process gets the job
+        self.assertTrue(job.claim())
+        self.assertFalse(job.claim())
+
+    def test_run_jobs(self):
+        job = self.enqueue(self.env.uid)
+        failing = self.enqueue(self.env.uid, format="unknown")
+        self.env["frepple.export.job"].run_jobs()
+
+        status = job.read()
+        self.assertEqual(status["status"], "done", status["error"])
+        self.assertEqual(status["done"], status["total"])
+        self.assertEqual(status["pid"], os.getpid())
+        self.assertTrue(all(i["status"] == "done" for i in status["sections"]))
+        with open(job.result_file, "rb") as f:
+            self.assertTrue(f.read().startswith(b"<?xml"))
+
+        status = failing.read()
+        self.assertEqual(status["status"], "failed")
+        self.assertTrue(status["error"])
+
+        # A job runs only once
+        self.assertEqual(ExportJob.queued(self.env.cr.dbname), [])
+
+    def test_stopped_process(self):
+        job = self.enqueue(self.env.uid)
+        self.assertTrue(job.claim())
+        # A pid above the maximum of linux doesn't exist
+        job.update(status="running", host=socket.gethostname(), pid=4194305)
+        self.assertEqual(job.read()["status"], "failed")
+        # The failure is stored
+        with open(job.status_file, "r") as f:
+            self.assertEqual(json.load(f)["status"], "failed")
+
+    def test_cleanup(self):
+        job = self.enqueue(self.env.uid)
+        # Never picked up by the scheduled action
+        ExportJob.cleanup(-1)
+        self.assertEqual(job.read()["status"], "failed")
+        ExportJob.cleanup(-1)
+        self.assertIsNone(job.read())
+
+    def test_check_limits(self):
+        runner = self.env["frepple.export.job"]
+        with patch.dict(tools.config.options, {"workers": 0}):
+            self.assertIsNone(runner.check_limits())
+        with patch.dict(
+            tools.config.options,
+            {"workers": 2, "limit_time_real": 120, "limit_time_real_cron": -1},
+        ):
+            self.assertIn("120 seconds", runner.check_limits())
+        with patch.dict(
+            tools.config.options,
+            {"workers": 2, "limit_time_real": 120, "limit_time_real_cron": 0},
+        ):
+            self.assertIsNone(runner.check_limits())
+
+
+@tagged("post_install", "-at_install")
+class TestJobStatus(JobFolder, common.HttpCase):
+    def setUp(self):
+        super(TestJobStatus, self).setUp()
+        self.users = [
+            self.env["res.users"].create(
+                {
+                    "name": "frePPLe job user %s" % i,
+                    "login": "frepple_job_%s" % i,
+                    "password": "frepple_job_%s" % i,
+                    "groups_id": [(6, 0, [self.env.ref("base.group_user").id])],
+                }
+            )
+            for i in range(2)
+        ]
+
+    def get(self, url, user):
+        auth = base64.b64encode(
+            ("%s:%s" % (user.login, user.login)).encode("utf-8")
+        ).decode("ascii")
+        # url_open doesn't accept headers on Odoo 12
+        return self.opener.get(
+            "http://%s:%s%s?database=%s" % (HOST, PORT, url, self.env.cr.dbname),
+            headers={"Authorization": "Basic %s" % auth},
+            timeout=10,
+        )
+
+    def test_status(self):
+        job = self.enqueue(self.users[0].id)
+        url = "/frepple/xml/job/%s" % job.id
+
+        res = self.get(url, self.users[0])
+        self.assertEqual(res.status_code, 200)
+        status = res.json()
+        self.assertEqual(status["status"], "queued")
+        self.assertEqual(status["url"], "%s/result" % url)
+        for key in ("uid", "pid", "context", "options"):
+            self.assertNotIn(key, status)
+
+        # Jobs of other users and unknown jobs don't exist
+        self.assertEqual(self.get(url, self.users[1]).status_code, 404)
+        self.assertEqual(
+            self.get("/frepple/xml/job/%s" % ("0" * 32), self.users[0]).status_code,
+            404,
+        )
+
+        # The result is only available when the job is done
+        self.assertEqual(self.get("%s/result" % url, self.users[0]).status_code, 409)
+        with open(job.result_file, "wb") as f:
+            f.write(b"<plan/>")
+        job.update(status="done")
+        res = self.get("%s/result" % url, self.users[0])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b"<plan/>")
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import re
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from pytz import timezone
+
+from odoo.tests import common, tagged
+
+from odoo.addons.frepple.controllers.outbound import (
+    DateFormatter,
+    JSONSerializer,
+    exporter,
+)
+
+
+@tagged("post_install", "-at_install")
+class TestOutbound(common.TransactionCase):
+    def setUp(self):
+        super(TestOutbound, self).setUp()
+        self.company = self.env.ref("base.main_company")
+        self.other_company = self.env["res.company"].create(
+            {"name": "frePPLe other company"}
+        )
+        # The superuser bypasses the record rules
+        self.user = self.env["res.users"].create(
+            {
+                "name": "frePPLe connector",
+                "login": "frepple_connector",
+                "company_id": self.company.id,
+                "company_ids": [(6, 0, [self.company.id])],
+                "groups_id": [
+                    (
+                        6,
+                        0,
+                        [
+                            self.env.ref("base.group_user").id,
+                            self.env.ref("stock.group_stock_user").id,
+                            self.env.ref("mrp.group_mrp_user").id,
+                            self.env.ref("purchase.group_purchase_user").id,
+                        ],
+                    )
+                ],
+            }
+        )
+
+    def export(self, **kwargs):
+        """
+        Returns the document exported as the connector user, without the
+        statistics, which differ between runs.
+        """
+        env = self.env(user=self.user.id)
+        lang = kwargs.pop("lang", None)
+        if lang:
+            env = env(context=dict(env.context, lang=lang))
+        kwargs.setdefault("use_cache", False)
+        kwargs.setdefault("watermarks", False)
+        xp = exporter(
+            SimpleNamespace(env=env),
+            uid=self.user.id,
+            database=env.cr.dbname,
+            company=self.company.name,
+            **kwargs
+        )
+        return re.sub(
+            r"<!-- export statistics.*?-->\n", "", "".join(xp.run()), flags=re.S
+        )
+
+    def test_sql_readers(self):
+        # Records of another company, archived records and records of the
+        # company of the connector user
+        partner = self.env["res.partner"].create(
+            {"name": "frePPLe supplier", "supplier": True, "customer": True}
+        )
+        other_partner = self.env["res.partner"].create(
+            {
+                "name": "frePPLe other supplier",
+                "supplier": True,
+                "customer": True,
+                "company_id": self.other_company.id,
+            }
+        )
+        self.env["res.partner"].create(
+            {"name": "frePPLe archived customer", "customer": True, "active": False}
+        )
+        for name, company, partners in (
+            ("frePPLe product", self.company, partner | other_partner),
+            ("frePPLe other product", self.other_company, partner),
+        ):
+            self.env["product.template"].create(
+                {
+                    "name": name,
+                    "type": "product",
+                    "company_id": company.id,
+                    "seller_ids": [
+                        (
+                            0,
+                            0,
+                            {
+                                "name": p.id,
+                                "min_qty": 1,
+                                "price": 10,
+                                "company_id": p.company_id.id or company.id,
+                            },
+                        )
+                        for p in partners
+                    ],
+                }
+            )
+        self.env["product.template"].create(
+            {"name": "frePPLe archived product", "type": "product", "active": False}
+        )
+
+        orm = self.export()
+        sql = self.export(sql_readers=True)
+        self.assertEqual(orm, sql)
+        self.assertIn("frePPLe product", sql)
+        self.assertIn("%s frePPLe supplier" % partner.id, sql)
+        self.assertNotIn("frePPLe other product", sql)
+        self.assertNotIn("frePPLe other supplier", sql)
+        self.assertNotIn("frePPLe archived", sql)
+
+    def test_calendar_horizon(self):
+        env = self.env(user=self.user.id)
+        xp = exporter(SimpleNamespace(env=env), uid=self.user.id, calendar_horizon=28)
+        start = datetime(2020, 1, 1)
+        end = datetime(2030, 1, 1)
+        weeks = xp.calendar_weeks(start, end, 0, "UTC")
+        # Every other week of the 4 weeks of the horizon
+        self.assertEqual(len(weeks), 2)
+        self.assertGreaterEqual(weeks[0][0], xp.calendar_start.isoformat())
+        self.assertLessEqual(
+            weeks[-1][1], (xp.calendar_start + timedelta(days=28)).isoformat()
+        )
+        # The same weeks as the complete expansion
+        xp.calendar_horizon = None
+        self.assertTrue(set(weeks) < set(xp.calendar_weeks(start, end, 0, "UTC")))
+
+    def test_calendar_expansion(self):
+        # Two-week calendars only exist from Odoo 13 on. Before, every
+        # attendance is a single bucket, whatever the horizon.
+        two_weeks = "week_type" in self.env["resource.calendar.attendance"]._fields
+        attendance = {"name": "Monday", "dayofweek": "0", "hour_from": 8, "hour_to": 12}
+        values = {"name": "frePPLe calendar", "tz": self.user.tz or "UTC"}
+        if two_weeks:
+            values["two_weeks_calendar"] = True
+            values["attendance_ids"] = [
+                (0, 0, dict(attendance, week_type=week_type))
+                for week_type in ("0", "1")
+            ]
+        else:
+            values["attendance_ids"] = [(0, 0, attendance)]
+        self.env["resource.calendar"].create(values)
+        complete = self.export()
+        limited = self.export(calendar_horizon=28)
+
+        def calendar(document):
+            start = document.index('<calendar name="frePPLe calendar"')
+            return document[start : document.index("</calendar>", start)]
+
+        if two_weeks:
+            # A bucket for every week from 2020 till 2030, or for the 4 weeks
+            # of the horizon
+            self.assertGreater(calendar(complete).count("<bucket "), 400)
+            self.assertEqual(calendar(limited).count("<bucket "), 4)
+        else:
+            self.assertEqual(calendar(complete).count("<bucket "), 1)
+            self.assertIn('days="2"', calendar(complete))
+            self.assertEqual(calendar(complete), calendar(limited))
+
+    def test_snapshot_settings(self):
+        def settings(uid, **kwargs):
+            env = self.env(user=uid, context={"lang": "en_US"})
+            xp = exporter(
+                SimpleNamespace(env=env),
+                uid=uid,
+                database=env.cr.dbname,
+                company=self.company.name,
+                **kwargs
+            )
+            return xp.snapshot_settings(), xp.data_fingerprint()
+
+        connector = settings(self.user.id)
+        self.assertEqual(connector, settings(self.user.id))
+        # Another user, or other settings, never get the same snapshot
+        for other in (
+            settings(self.env.uid),
+            settings(self.user.id, sql_readers=True),
+            settings(self.user.id, calendar_horizon=28),
+        ):
+            self.assertNotEqual(connector[0], other[0])
+            self.assertNotEqual(connector[1], other[1])
+
+    def block(self, document, tag):
+        """
+        Returns the content of the element with the tag, or an empty string
+        when the document doesn't have it.
+        """
+        start = document.find("<%s>" % tag)
+        if start < 0:
+            return ""
+        return document[start : document.index("</%s>" % tag, start)]
+
+    def later(self):
+        """
+        Moves the watermarks after the write date of the records created by
+        the test, as if the previous export ran after them.
+        """
+        self.env.cr.execute(
+            "UPDATE frepple_export_watermark "
+            "SET watermark = (now() at time zone 'UTC') + interval '1 minute'"
+        )
+        self.env["frepple.export.watermark"].invalidate_cache()
+
+    def test_incremental(self):
+        partner = self.env["res.partner"].create(
+            {"name": "frePPLe incremental customer", "customer": True}
+        )
+        products = self.env["product.product"]
+        for i in range(2):
+            products |= products.create(
+                {"name": "frePPLe incremental product %s" % i, "type": "product"}
+            )
+        complete = self.export(mode=1, watermarks=True)
+        self.assertIn("frePPLe incremental product 0", self.block(complete, "items"))
+
+        # Nothing changed since the complete export
+        self.later()
+        incremental = self.export(mode=3, watermarks=True)
+        for tag, element in (
+            ("customers", "<customer "),
+            ("suppliers", "<supplier "),
+            ("items", "<item "),
+            ("operations", "<operation "),
+        ):
+            self.assertNotIn(element, self.block(incremental, tag))
+
+        # Only the changed product is sent again
+        self.later()
+        self.env.cr.execute(
+            "UPDATE product_product "
+            "SET write_date = (now() at time zone 'UTC') + interval '2 minutes' "
+            "WHERE id = %s",
+            (products[0].id,),
+        )
+        products.invalidate_cache()
+        items = self.block(self.export(mode=3, watermarks=True), "items")
+        self.assertIn("frePPLe incremental product 0", items)
+        self.assertNotIn("frePPLe incremental product 1", items)
+
+        # Archived records are removed
+        self.later()
+        partner.active = False
+        products[1].active = False
+        incremental = self.export(mode=3, watermarks=True)
+        self.assertIn(
+            '<customer name="%s %s" action="R"/>' % (partner.id, partner.name),
+            self.block(incremental, "customers"),
+        )
+        self.assertIn(
+            '<item name="frePPLe incremental product 1" action="R"/>',
+            self.block(incremental, "items"),
+        )
+
+    def test_failed_record_resent(self):
+        env = self.env(user=self.user.id)
+        xp = exporter(SimpleNamespace(env=env), uid=self.user.id, mode=3)
+        xp.delta_watermarks = {
+            "item": (datetime(2020, 1, 1), {"1": "changed", "2": "unchanged"})
+        }
+        xp.delta_current = {}
+        xp.delta_emitted = {}
+        xp.delta_pending = {}
+        self.assertTrue(xp.is_changed("item", 1, "changed", datetime(2021, 1, 1)))
+        self.assertFalse(xp.is_changed("item", 2, "unchanged", datetime(2019, 1, 1)))
+        # The element of the changed record failed: it isn't registered as
+        # exported, such that the next export sends it again, and it isn't
+        # removed either
+        self.assertEqual(xp.delta_current, {"item": {"2": "unchanged"}})
+        self.assertEqual(list(xp.deleted_records("item")), [])
+        self.assertTrue(xp.is_changed("item", 3, "new"))
+        xp.exported("item", 3)
+        self.assertEqual(xp.delta_current["item"]["3"], "new")
+        self.assertEqual(xp.delta_emitted["item"], {"3"})
+
+    def test_cache_language(self):
+        self.env["res.lang"].load_lang("fr_FR")
+        component = self.env["product.product"].create(
+            {"name": "frePPLe component", "type": "product"}
+        )
+        component.with_context(lang="fr_FR").name = "frePPLe composant"
+        finished = self.env["product.product"].create(
+            {"name": "frePPLe finished product", "type": "product"}
+        )
+        self.env["mrp.bom"].create(
+            {
+                "product_tmpl_id": finished.product_tmpl_id.id,
+                "product_qty": 1,
+                "bom_line_ids": [
+                    (0, 0, {"product_id": component.id, "product_qty": 2})
+                ],
+            }
+        )
+        # The BOMs are cached after the first export. The second export must
+        # not get the names of the first language.
+        english = self.block(self.export(use_cache=True, lang="en_US"), "operations")
+        french = self.block(self.export(use_cache=True, lang="fr_FR"), "operations")
+        self.assertIn("frePPLe component", english)
+        self.assertIn("frePPLe composant", french)
+        self.assertNotIn("frePPLe component", french)
+
+    def test_attendance_priorities(self):
+        # Created after the Tuesday attendance, the Monday attendance has the
+        # higher id
+        self.env["resource.calendar"].create(
+            {
+                "name": "frePPLe attendance order",
+                "tz": self.user.tz or "UTC",
+                "attendance_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "name": name,
+                            "dayofweek": dayofweek,
+                            "hour_from": 8,
+                            "hour_to": 12,
+                        },
+                    )
+                    for name, dayofweek in (("Tuesday", "1"), ("Monday", "0"))
+                ],
+            }
+        )
+        document = self.export()
+        start = document.index('<calendar name="frePPLe attendance order"')
+        buckets = re.findall(
+            r'days="(\d+)" priority="(\d+)"',
+            document[start : document.index("</calendar>", start)],
+        )
+        # Monday is day 1 in frePPLe, Tuesday day 2
+        self.assertEqual(buckets, [("2", "1000"), ("4", "1001")])
+
+    def test_json_serializer(self):
+        document = (
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'source="odoo_1">\n'
+            "<calendars>\n"
+            '<calendar name="c"><buckets><bucket start="a"/></buckets>'
+            '<buckets><bucket start="b"/></buckets></calendar>\n'
+            "</calendars>\n"
+            "<operations>\n"
+            '<operation name="o" xsi:type="operation_time_per"><item name="i"/>'
+            '<flows><flow xsi:type="flow_end" quantity="1"><item name="i"/></flow>'
+            "</flows><loads></loads></operation>\n"
+            "</operations>\n"
+            "<!-- export statistics -->\n"
+            "</plan>\n"
+        )
+        # Fed in small pieces, like the chunks of an export
+        serializer = JSONSerializer()
+        output = "".join(
+            serializer.feed(document[i : i + 7]) for i in range(0, len(document), 7)
+        )
+        output += serializer.close()
+        records = [json.loads(i) for i in output.splitlines()]
+        self.assertEqual(
+            records,
+            [
+                {"tag": "plan", "source": "odoo_1"},
+                {
+                    "section": "calendars",
+                    "tag": "calendar",
+                    "name": "c",
+                    "buckets": [{"start": "a"}, {"start": "b"}],
+                },
+                {
+                    "section": "operations",
+                    "tag": "operation",
+                    "name": "o",
+                    "xsi:type": "operation_time_per",
+                    "item": {"name": "i"},
+                    # A list, also for a single flow or no load
+                    "flows": [
+                        {"xsi:type": "flow_end", "quantity": "1", "item": {"name": "i"}}
+                    ],
+                    "loads": [],
+                },
+            ],
+        )
+        # Only the list elements can be repeated
+        serializer = JSONSerializer()
+        with self.assertRaises(ValueError):
+            serializer.feed(
+                '<plan><items><item name="i"><location name="a"/>'
+                '<location name="b"/></item></items></plan>'
+            )
+
+    def test_json_export(self):
+        env = self.env(user=self.user.id)
+        xp = exporter(
+            SimpleNamespace(env=env),
+            uid=self.user.id,
+            database=env.cr.dbname,
+            company=self.company.name,
+            use_cache=False,
+            watermarks=False,
+            format="json",
+        )
+        records = [json.loads(i) for i in "".join(xp.run_chunked()).splitlines()]
+        self.assertEqual(records[0]["tag"], "plan")
+        for i in records[1:]:
+            self.assertIn("section", i)
+            for tag in JSONSerializer.list_tags:
+                if tag in i:
+                    self.assertIsInstance(i[tag], list)
+
+
+@tagged("post_install", "-at_install")
+class TestDateFormatter(common.BaseCase):
+    # Days with a daylight saving transition, and a timezone without
+    timezones = (
+        ("NZ", (date(2021, 4, 4), date(2021, 9, 26))),
+        ("Australia/Lord_Howe", (date(2021, 4, 4), date(2021, 10, 3))),
+        ("America/Chicago", (date(2021, 3, 14), date(2021, 11, 7))),
+        ("Asia/Kolkata", (date(2021, 3, 14),)),
+    )
+
+    def datetimes(self, days):
+        """
+        Every 20 minutes and 17 seconds of the day before, of and after the
+        days.
+        """
+        for day in days:
+            d = datetime.combine(day, datetime.min.time()) - timedelta(days=1)
+            end = d + timedelta(days=3)
+            while d < end:
+                yield d
+                d += timedelta(minutes=20, seconds=17)
+
+    def test_format(self):
+        formatter = DateFormatter("UTC")
+        for tz, days in self.timezones:
+            for d in self.datetimes(days):
+                with self.subTest(tz=tz, d=d):
+                    # The expressions the exporter used before
+                    expected = d.astimezone(timezone(tz)).strftime("%Y-%m-%dT%H:%M:%S")
+                    self.assertEqual(formatter.format(d, tz), expected)
+                    self.assertEqual(formatter.format(d.isoformat(), tz), expected)
+                    self.assertEqual(
+                        formatter.format_utc(d, tz),
+                        str(
+                            timezone("UTC").localize(d).astimezone(timezone(tz))
+                        ).replace(" ", "T")[:19],
+                    )
+
+    def test_default_timezone(self):
+        formatter = DateFormatter("NZ")
+        d = datetime(2021, 1, 1, 12)
+        self.assertEqual(formatter.format_utc(d), formatter.format_utc(d, "NZ"))
+        self.assertEqual(formatter.format_utc(d), "2021-01-02T01:00:00")
+        self.assertEqual(
+            formatter.format(date(2021, 1, 1)),
+            datetime(2021, 1, 1)
+            .astimezone(timezone("NZ"))
+            .strftime("%Y-%m-%dT%H:%M:%S"),
+        )